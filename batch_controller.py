@@ -0,0 +1,231 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import time
+import resource
+
+
+# Default size of the first batch, if settings_kpi has no observations_batchsize
+DEFAULT_BATCHSIZE = 256
+
+# Share of RSS limit, which batch peak RSS should not exceed; batch size is halved after exceeding it
+BACKOFF_RSS_SHARE = 0.9
+
+# Weight of the last batch in moving average of per observation time
+SMOOTHING = 0.5
+
+
+def get_rss():
+    """Returns resident set size of current process in bytes
+
+    Returns:
+        :return: current RSS (peak RSS if current one is not available on platform)
+        :rtype: int
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_peak_rss():
+    """Returns peak resident set size of current process in bytes
+
+    Returns:
+        :return: peak RSS since process start or since the last successful reset_peak_rss call
+        :rtype: int
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """Reset peak RSS of current process to current RSS (Linux 4.0+)
+
+    Returns:
+        :return: True if peak RSS was reset, False if platform does not support it
+        :rtype: bool
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def create_sizer(settings_kpi):
+    """Returns AdaptiveBatchSizer object if RSS or latency target is set in settings_kpi, otherwise None
+
+    Args:
+        :param settings_kpi: dict object with KPI settings from config
+        :type settings_kpi: dict
+    Returns:
+        :return: AdaptiveBatchSizer object or None
+        :rtype: AdaptiveBatchSizer
+    """
+    target_rss_mb = settings_kpi.get('target_rss_mb', 0)
+    target_latency = settings_kpi.get('target_batch_latency', 0)
+    if not target_rss_mb and not target_latency:
+        return None
+    initial_size = int(settings_kpi.get('observations_batchsize', 0)) or DEFAULT_BATCHSIZE
+    return AdaptiveBatchSizer(initial_size,
+                              target_rss=target_rss_mb * 1024 * 1024 if target_rss_mb else None,
+                              target_latency=target_latency or None)
+
+
+class AdaptiveBatchSizer:
+    """Controller of observations batch size, driven by measured time and memory per batch
+
+    Properties:
+        batch_size: integer with size of the next batch
+        target_rss: integer with RSS limit in bytes or None
+        target_latency: float with target time of one batch processing in seconds or None
+        min_size: integer with minimal batch size
+        max_size: integer with maximal batch size
+
+    Public methods:
+        update(self, batch_size, elapsed, rss_before, rss_after, rss_peak=None): adjusts batch size after
+            processed batch
+        stats(self): returns dict with controller metrics
+    """
+
+    def __init__(self, initial_size, target_rss=None, target_latency=None, min_size=1, max_size=100000):
+        """AdaptiveBatchSizer class constructor
+
+        :param initial_size: integer with size of the first batch
+        :type initial_size: int
+        :param target_rss: integer with RSS limit in bytes
+        :type target_rss: int
+        :param target_latency: float with target time of one batch processing in seconds
+        :type target_latency: float
+        :param min_size: integer with minimal batch size
+        :type min_size: int
+        :param max_size: integer with maximal batch size
+        :type max_size: int
+        """
+        self.batch_size = max(min_size, min(initial_size, max_size))
+        self.target_rss = target_rss
+        self.target_latency = target_latency
+        self.min_size = min_size
+        self.max_size = max_size
+        self.batches = 0
+        self.backoffs = 0
+        self.last_rss = None
+        self.max_peak_rss = None
+        self._time_per_observation = None
+        self._peak_per_observation = None
+
+    @staticmethod
+    def _smooth(average, value):
+        return value if average is None else SMOOTHING * value + (1 - SMOOTHING) * average
+
+    def update(self, batch_size, elapsed, rss_before, rss_after, rss_peak=None):
+        """Adjust size of the next batch by measurements of processed batch
+
+        Args:
+            :param batch_size: integer with size of processed batch
+            :type batch_size: int
+            :param elapsed: float with batch processing time in seconds
+            :type elapsed: float
+            :param rss_before: integer with RSS before batch processing in bytes
+            :type rss_before: int
+            :param rss_after: integer with RSS after batch processing in bytes
+            :type rss_after: int
+            :param rss_peak: integer with peak RSS during batch processing in bytes, rss_after if not set
+            :type rss_peak: int
+        Batch size grows at most twice per batch. Memory of batch is measured by its peak RSS, as memory
+        released after batch is reused by the next one and current RSS hardly changes after allocator warmup.
+        The next batch is sized, so that current RSS plus the worst observed peak growth per observation
+        times batch size stays below BACKOFF_RSS_SHARE of the limit; if batch peak still exceeds it,
+        batch size is halved.
+        """
+        rss_peak = max(rss_peak if rss_peak is not None else rss_after, rss_after)
+        self.batches += 1
+        self.last_rss = rss_after
+        self.max_peak_rss = rss_peak if self.max_peak_rss is None else max(self.max_peak_rss, rss_peak)
+        self._time_per_observation = self._smooth(self._time_per_observation, elapsed / batch_size)
+        peak_per_observation = max(rss_peak - rss_before, 0) / batch_size
+        if self._peak_per_observation is None or peak_per_observation > self._peak_per_observation:
+            self._peak_per_observation = peak_per_observation
+
+        if self.target_rss is not None and rss_peak >= BACKOFF_RSS_SHARE * self.target_rss:
+            self.backoffs += 1
+            self.batch_size = max(self.min_size, self.batch_size // 2)
+            return
+
+        size = 2 * self.batch_size
+        if self.target_latency is not None and self._time_per_observation > 0:
+            size = min(size, int(self.target_latency / self._time_per_observation))
+        if self.target_rss is not None and self._peak_per_observation > 0:
+            headroom = BACKOFF_RSS_SHARE * self.target_rss - rss_after
+            size = min(size, int(headroom / self._peak_per_observation))
+        self.batch_size = max(self.min_size, min(size, self.max_size))
+
+    def stats(self):
+        """Returns dict with controller metrics
+
+        Returns:
+            :return: dict object with batches number, next batch size, number of backoffs, last measured RSS
+                and maximal batch peak RSS
+            :rtype: dict
+        """
+        return {'batches': self.batches,
+                'batch_size': self.batch_size,
+                'batch_backoffs': self.backoffs,
+                'rss_mb': round(self.last_rss / 1024 / 1024, 1) if self.last_rss is not None else None,
+                'peak_rss_mb': round(self.max_peak_rss / 1024 / 1024, 1) if self.max_peak_rss is not None else None}
+
+
+def batched_act(act, observations, sizer):
+    """Process observations in batches of size, adjusted by sizer after each batch
+
+    Args:
+        :param act: function, which takes list of observations and returns list of predictions
+        :type act: function
+        :param observations: list or ObservationBatch object containing observations
+        :type observations: list
+        :param sizer: AdaptiveBatchSizer object
+        :type sizer: AdaptiveBatchSizer
+    Returns:
+        :return: list object containing predictions in order of observations
+        :rtype: list
+    Peak RSS is reset before each batch where platform allows it. Otherwise it is process lifetime peak
+    and is taken as batch peak only when batch raised it.
+    """
+    predictions = []
+    offset = 0
+    while offset < len(observations):
+        batch = observations[offset:offset + sizer.batch_size]
+        peak_reset = reset_peak_rss()
+        rss_before = get_rss()
+        peak_before = get_peak_rss()
+        start_time = time.perf_counter()
+        predictions.extend(act(batch))
+        elapsed = time.perf_counter() - start_time
+        rss_after = get_rss()
+        peak_after = get_peak_rss()
+        rss_peak = peak_after if peak_reset or peak_after > peak_before else rss_after
+        sizer.update(len(batch), elapsed, rss_before, rss_after, rss_peak)
+        offset += len(batch)
+    return predictions
@@ -0,0 +1,112 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+import sys
+import timeit
+import argparse
+
+import conll_utils as cu
+
+
+def legacy_preprocess_lines(conll_str):
+    """Previous KPI11 tester conll preprocessing (three regex passes over the whole document)
+    """
+    doc_num = str(re.search(r'#begin document [(].+[)];\n([0-9]+)', conll_str).group(1))
+    conll_str = re.sub(r'(?P<subst>#begin document [(].+[)];)',
+                       '#begin document(%s); part 0' % doc_num,
+                       conll_str)
+    match = re.search(r'\n\n#end document', conll_str)
+    if match is None:
+        conll_str = re.sub(r'\n#end document', r'\n\n#end document', conll_str)
+    return conll_str.split('\n')
+
+
+def legacy_extract_coref(conll):
+    """Previous KPI11 tester coreference extraction (string concatenation in loop)
+    """
+    coref_str = ''
+    lines = conll.split('\n')
+    for i in range(len(lines)):
+        if lines[i].startswith("#begin"):
+            coref_str += ' '
+        elif lines[i].startswith("#end document"):
+            coref_str += ' '
+        else:
+            row = lines[i].split('\t')
+            if len(row) == 1:
+                coref_str += ' '
+            else:
+                coref_str += row[-1] + ' '
+    return coref_str
+
+
+def make_document(lines_num, end_gap=False):
+    """Returns synthetic conll document with coreference column
+
+    Args:
+        :param lines_num: number of token lines in document
+        :type lines_num: int
+        :param end_gap: bool flag, turns on/off empty line before '#end document'
+        :type end_gap: bool
+    Returns:
+        :return: string with conll formatted document
+        :rtype: str
+    """
+    lines = ['#begin document (bc/cctv/00/cctv_0001);']
+    for i in range(lines_num):
+        if i % 20 == 19:
+            lines.append('')
+        lines.append('%s\tbc/cctv/00/cctv_0001\t0\t%s\tword%s\tNN\t*\t-\t-\tSpeaker#1\t*\t(%s)'
+                     % (i + 1, i % 20, i, i % 7))
+    if end_gap:
+        lines.append('')
+    lines.append('#end document')
+    return '\n'.join(lines)
+
+
+def main(argv):
+    """Check equivalence of conll_utils with previous implementation and print timings of both
+
+    Args:
+        :param argv: set of raw command line arguments
+        :type argv: list
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, action='store', dest='n', default=20000,
+                        help='number of token lines in benchmark document')
+    parser.add_argument('-r', type=int, action='store', dest='r', default=5, help='number of repeats')
+    args = parser.parse_args(argv)
+
+    documents = [make_document(args.n), make_document(args.n, end_gap=True)]
+    for document in documents:
+        lines = cu.preprocess_lines(document)
+        assert lines == legacy_preprocess_lines(document)
+        assert cu.extract_coref('\n'.join(lines)) == legacy_extract_coref('\n'.join(lines))
+
+    document = documents[0]
+    prediction = '\n'.join(cu.preprocess_lines(document))
+    timings = [('preprocess (legacy)', lambda: legacy_preprocess_lines(document)),
+               ('preprocess (conll_utils)', lambda: cu.preprocess_lines(document)),
+               ('extract_coref (legacy)', lambda: legacy_extract_coref(prediction)),
+               ('extract_coref (conll_utils)', lambda: cu.extract_coref(prediction))]
+    print('Document: %s lines, %s characters' % (args.n, len(document)))
+    for name, func in timings:
+        best = min(timeit.repeat(func, number=1, repeat=args.r))
+        print('%-30s %.4f s' % (name, best))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
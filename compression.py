@@ -0,0 +1,178 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import zlib
+import queue
+import itertools
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# zlib wbits values for HTTP content codings
+_ZLIB_WBITS = {'gzip': 31, 'deflate': 15}
+
+# Number of compressed chunks buffered between compressing thread and request sending
+_QUEUE_SIZE = 16
+
+
+def accept_encoding(encoding):
+    """Returns value of Accept-Encoding header for GET request
+
+    Args:
+        :param encoding: string with content coding from settings_kpi 'compression' ('', 'gzip', 'deflate', 'zstd')
+        :type encoding: str
+    Returns:
+        :return: string with Accept-Encoding header value or None if default header should be used
+        :rtype: str
+    zstd is offered only if zstandard package is installed.
+    """
+    if not encoding:
+        return None
+    if encoding == 'zstd' and zstandard is not None:
+        return 'zstd, gzip, deflate'
+    return 'gzip, deflate'
+
+
+def iter_content(response, chunk_size):
+    """Returns decoded content of streamed response
+
+    Args:
+        :param response: requests Response object of request made with stream=True
+        :type response: requests.Response
+        :param chunk_size: size of read chunks in bytes
+        :type chunk_size: int
+    Returns:
+        :return: generator of bytes objects with decoded response content
+        :rtype: generator
+    gzip and deflate are decoded by requests, zstd is decoded here.
+    """
+    if response.headers.get('Content-Encoding', '').strip().lower() != 'zstd':
+        return response.iter_content(chunk_size=chunk_size)
+    return _iter_zstd_content(response, chunk_size)
+
+
+def _iter_zstd_content(response, chunk_size):
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    for chunk in response.raw.stream(chunk_size, decode_content=False):
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+
+
+def _compressor(encoding):
+    if encoding in _ZLIB_WBITS:
+        return zlib.compressobj(6, zlib.DEFLATED, _ZLIB_WBITS[encoding])
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstandard package is required for zstd compression')
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError('Unsupported compression: %s' % encoding)
+
+
+def compress(chunks, encoding):
+    """Compress stream of bytes chunks
+
+    Args:
+        :param chunks: iterable of bytes objects
+        :type chunks: iterable
+        :param encoding: string with content coding ('gzip', 'deflate' or 'zstd')
+        :type encoding: str
+    Returns:
+        :return: generator of bytes objects with compressed data
+        :rtype: generator
+    """
+    compressor = _compressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_body(chunks, encoding):
+    """Compress stream of bytes chunks to one bytes object, in background thread if stream has several chunks
+
+    Args:
+        :param chunks: iterable of bytes objects (e.g. json_stream.iter_encode output)
+        :type chunks: iterable
+        :param encoding: string with content coding ('gzip', 'deflate' or 'zstd')
+        :type encoding: str
+    Returns:
+        :return: compressed data
+        :rtype: bytes
+    Body of request, which is not streamed: small bodies (one chunk) are compressed in place, large ones are
+    produced and compressed chunk by chunk in background thread, so neither the whole uncompressed text
+    nor its bytes are held in memory together with compressed data.
+    """
+    chunks = iter(chunks)
+    head = list(itertools.islice(chunks, 2))
+    if len(head) < 2:
+        return b''.join(compress(head, encoding))
+    return b''.join(compress_threaded(itertools.chain(head, chunks), encoding))
+
+
+def compress_threaded(chunks, encoding):
+    """Compress stream of bytes chunks in background thread
+
+    Args:
+        :param chunks: iterable of bytes objects
+        :type chunks: iterable
+        :param encoding: string with content coding ('gzip', 'deflate' or 'zstd')
+        :type encoding: str
+    Returns:
+        :return: generator of bytes objects with compressed data
+        :rtype: generator
+    Producing and compressing of chunks runs in background thread, while the caller sends already compressed
+    chunks, so serialisation, compression and network transfer of large bodies overlap.
+    """
+    compressor = _compressor(encoding)
+    compressed = queue.Queue(maxsize=_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def worker():
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    return
+                data = compressor.compress(chunk)
+                if data:
+                    compressed.put(data)
+            compressed.put(compressor.flush())
+            compressed.put(None)
+        except Exception as e:
+            compressed.put(e)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            data = compressed.get()
+            if data is None:
+                break
+            if isinstance(data, Exception):
+                raise data
+            yield data
+    finally:
+        stop.set()
+        # Unblock worker if it waits on full queue
+        while thread.is_alive():
+            try:
+                compressed.get(timeout=0.1)
+            except queue.Empty:
+                pass
@@ -0,0 +1,89 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+
+
+# Document header line: '#begin document (<name>);', document number is on the next line
+_DOCUMENT_NUMBER = re.compile(r'#begin document [(].+[)];\n([0-9]+)')
+_BEGIN_DOCUMENT = re.compile(r'#begin document [(].+[)];')
+_END_DOCUMENT = '#end document'
+_COREF_SKIP_PREFIXES = ('#begin', _END_DOCUMENT)
+
+
+def preprocess_lines(conll_str):
+    """Split conll document to lines and normalise its header and footer for coreference agent
+
+    Args:
+        :param conll_str: string with conll formatted document from KPI11 task
+        :type conll_str: str
+    Returns:
+        :return: list of conll lines
+        :rtype: list
+    Document header '#begin document (<name>);' is replaced with '#begin document(<number>); part 0',
+    where number is taken from the line following the header, and empty line is inserted
+    before '#end document' lines if the document has no empty line before any of them.
+    """
+    match = _DOCUMENT_NUMBER.search(conll_str)
+    if match is None:
+        raise ValueError('Document number is not found in conll document header')
+    conll_str = _BEGIN_DOCUMENT.sub('#begin document(%s); part 0' % match.group(1), conll_str)
+    if '\n\n' + _END_DOCUMENT not in conll_str:
+        conll_str = conll_str.replace('\n' + _END_DOCUMENT, '\n\n' + _END_DOCUMENT)
+    return conll_str.split('\n')
+
+
+def make_observation(conll_str):
+    """Returns coreference agent observation for conll document
+
+    Args:
+        :param conll_str: string with conll formatted document from KPI11 task
+        :type conll_str: str
+    Returns:
+        :return: dict object with observation in format, compatible with agent API
+        :rtype: dict
+    """
+    return {'conll': [], 'valid_conll': [preprocess_lines(conll_str)], 'id': ''}
+
+
+def iter_observations(tasks):
+    """Make coreference agent observations from KPI11 tasks one by one
+
+    Args:
+        :param tasks: iterable of task dicts with 'id' and 'question' keys, e.g. tasks['qas'] list
+            or tasks selected from json_stream.iter_object events with json_stream.iter_items
+        :type tasks: iterable
+    Returns:
+        :return: generator of tuples with task id and observation
+        :rtype: generator
+    """
+    for task in tasks:
+        yield task['id'], make_observation(str(task['question']))
+
+
+def extract_coref(conll):
+    """Extract coreference markup from conll formatted text
+
+    Args:
+        :param conll: string with conll text with coreference markup
+        :type conll: str
+    Returns:
+        :return: str object containing coreference markup (last column) of each line, separated by spaces
+        :rtype: str
+    """
+    columns = ['' if line.startswith(_COREF_SKIP_PREFIXES) or '\t' not in line else line[line.rfind('\t') + 1:]
+               for line in conll.split('\n')]
+    columns.append('')
+    return ' '.join(columns)
@@ -0,0 +1,263 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import sys
+import json
+import argparse
+import itertools
+import subprocess
+import tempfile
+
+
+# TensorFlow 2 thread pools settings of process, they can not be changed after TensorFlow runtime starts
+_tf2_threads = None
+
+
+def parse_cpulist(cpulist):
+    """Returns list of CPU numbers from cpulist string
+
+    Args:
+        :param cpulist: string in Linux cpulist format, e.g. '0-3,8,10-11'
+        :type cpulist: str
+    Returns:
+        :return: sorted list of CPU numbers
+        :rtype: list
+    """
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def get_numa_cpus(numa_node):
+    """Returns list of CPU numbers of NUMA node
+
+    Args:
+        :param numa_node: integer with NUMA node number
+        :type numa_node: int
+    Returns:
+        :return: list of CPU numbers
+        :rtype: list
+    """
+    with open('/sys/devices/system/node/node%s/cpulist' % numa_node) as f:
+        return parse_cpulist(f.read())
+
+
+def _set_tf_threads(intra_op_threads, inter_op_threads):
+    # Configure thread pools of TensorFlow session, used by Keras models of agents.
+    # Returns False if settings can not take effect: TensorFlow or (for TF1) Keras is not installed
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return False
+    if hasattr(tf, 'ConfigProto'):
+        try:
+            from keras import backend
+        except ImportError:
+            return False
+        session_config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                        inter_op_parallelism_threads=inter_op_threads)
+        backend.set_session(tf.Session(config=session_config))
+    else:
+        # Settings are applied once per process: repeated agent initialisation (e.g. -M or run_test with
+        # init_agent) keeps them, and other values can not take effect after runtime is started
+        global _tf2_threads
+        if _tf2_threads is not None:
+            return _tf2_threads == (intra_op_threads, inter_op_threads)
+        try:
+            if intra_op_threads:
+                tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+            if inter_op_threads:
+                tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        except RuntimeError:
+            return False
+        _tf2_threads = (intra_op_threads, inter_op_threads)
+    return True
+
+
+def apply(settings_agent, keras_session=True):
+    """Apply CPU configuration from settings_agent to current process
+
+    Args:
+        :param settings_agent: dict object with agent settings from config
+        :type settings_agent: dict
+        :param keras_session: flag, set if agent runs its models in Keras session; agents, which create
+            their own tf.Session, do not use thread pools settings
+        :type keras_session: bool
+    Returns:
+        :return: dict object with settings, which took effect
+        :rtype: dict
+    OpenMP and MKL threads numbers are passed through environment variables, so method should be called
+    before TensorFlow and numpy libraries are loaded, i.e. before agent module import in init_agent.
+    CPU affinity is a list of CPU numbers or cpulist string; numa_node binds process to CPUs of NUMA node,
+    both settings together bind it to CPUs of NUMA node from the list.
+    Keys: intra_op_threads, inter_op_threads, omp_threads, mkl_threads, cpu_affinity, numa_node,
+    not set or 0 values leave library defaults.
+    """
+    applied = {}
+    for key, variable in [('omp_threads', 'OMP_NUM_THREADS'), ('mkl_threads', 'MKL_NUM_THREADS')]:
+        if settings_agent.get(key):
+            os.environ[variable] = str(settings_agent[key])
+            applied[key] = settings_agent[key]
+
+    cpus = None
+    if settings_agent.get('numa_node') not in (None, '', -1):
+        cpus = get_numa_cpus(settings_agent['numa_node'])
+    if settings_agent.get('cpu_affinity'):
+        affinity = settings_agent['cpu_affinity']
+        affinity = parse_cpulist(affinity) if isinstance(affinity, str) else list(affinity)
+        if cpus is not None:
+            cpus = [cpu for cpu in cpus if cpu in affinity]
+            if not cpus:
+                raise ValueError('cpu_affinity %s has no CPUs of NUMA node %s' % (settings_agent['cpu_affinity'],
+                                                                                  settings_agent['numa_node']))
+        else:
+            cpus = affinity
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+        applied['cpus'] = ','.join(str(cpu) for cpu in sorted(os.sched_getaffinity(0)))
+
+    intra_op_threads = int(settings_agent.get('intra_op_threads', 0) or 0)
+    inter_op_threads = int(settings_agent.get('inter_op_threads', 0) or 0)
+    if intra_op_threads or inter_op_threads:
+        if keras_session and _set_tf_threads(intra_op_threads, inter_op_threads):
+            applied['intra_op_threads'] = intra_op_threads
+            applied['inter_op_threads'] = inter_op_threads
+        else:
+            print('intra_op_threads and inter_op_threads are not applied: agent does not use Keras session, '
+                  'TensorFlow/Keras is not installed or TensorFlow runtime is started with other values')
+    return applied
+
+
+def sweep(kpi_name, grid, run_args, config_path='config.json'):
+    """Run load test of KPI agent with each combination of CPU settings in separate process
+
+    Args:
+        :param kpi_name: string with KPI name
+        :type kpi_name: str
+        :param grid: dict object with settings_agent key -> list of values
+        :type grid: dict
+        :param run_args: list of additional 'run_test.py load' arguments (load options, -m, etc.)
+        :type run_args: list
+        :param config_path: path of base config
+        :type config_path: str
+    Returns:
+        :return: list of tuples with settings dict and load test report dict (None if run failed),
+            sorted by saturation throughput
+        :rtype: list
+    Each combination is tested in new process, as thread pools and affinity can not be reset in process.
+    Thread pools settings (intra_op_threads, inter_op_threads) can be swept only for agents, which run
+    models in Keras session, for others they do not take effect.
+    """
+    with open(config_path) as f:
+        base_config = json.load(f)
+    tf_keys = [key for key in ('intra_op_threads', 'inter_op_threads') if key in grid]
+    if tf_keys and not uses_keras_session(base_config, kpi_name):
+        raise ValueError('%s agent does not use Keras session, %s can not be swept' % (kpi_name, ', '.join(tf_keys)))
+    run_test_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_test.py')
+    keys = list(grid.keys())
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, values in enumerate(itertools.product(*[grid[key] for key in keys])):
+            settings = dict(zip(keys, values))
+            config = json.loads(json.dumps(base_config))
+            config['kpis'][kpi_name]['settings_agent'].update(settings)
+            variant_config_path = os.path.join(tmp_dir, 'config_%s.json' % i)
+            report_path = os.path.join(tmp_dir, 'report_%s.json' % i)
+            with open(variant_config_path, 'w') as f:
+                json.dump(config, f)
+            print('Testing %s...' % json.dumps(settings))
+            command = [sys.executable, run_test_path, 'load', '--report', report_path] + run_args + \
+                      ['-k', kpi_name, '--config', variant_config_path]
+            completed = subprocess.run(command, stdout=subprocess.DEVNULL)
+            report = None
+            if completed.returncode == 0 and os.path.isfile(report_path):
+                with open(report_path) as f:
+                    report = json.load(f)
+            results.append((settings, report))
+    results.sort(key=lambda result: -result[1]['saturation_rps'] if result[1] is not None else 0.0)
+    return results
+
+
+def uses_keras_session(config, kpi_name):
+    """Returns True if KPI agent runs its models in Keras session, so TensorFlow thread pools settings apply
+
+    Args:
+        :param config: dict object initialised with config.json
+        :type config: dict
+        :param kpi_name: string with KPI name
+        :type kpi_name: str
+    Returns:
+        :return: Tester class keras_session flag
+        :rtype: bool
+    """
+    tester_module = __import__(config['kpis'][kpi_name]['settings_kpi']['tester_file'])
+    return getattr(tester_module, 'Tester').keras_session
+
+
+def _values(text):
+    return [int(value) for value in text.split(',')]
+
+
+if __name__ == '__main__':
+    # Usage: python cpu_config.py -k kpi1 [--intra 1,2,4] [--inter 1,2] [--omp ...] [--mkl ...] -- [load test args]
+    # By default TensorFlow thread pools are swept for agents with Keras session, OpenMP threads for others
+    argv = sys.argv[1:]
+    run_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+    parser = argparse.ArgumentParser(prog='cpu_config.py')
+    parser.add_argument('-k', type=str, action='store', dest='k', required=True)
+    parser.add_argument('--intra', type=_values, action='store', dest='intra', default=None)
+    parser.add_argument('--inter', type=_values, action='store', dest='inter', default=None)
+    parser.add_argument('--omp', type=_values, action='store', dest='omp', default=None)
+    parser.add_argument('--mkl', type=_values, action='store', dest='mkl', default=None)
+    parser.add_argument('--config', type=str, action='store', dest='config', default='config.json')
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        keras_session = uses_keras_session(json.load(f), args.k)
+    if not keras_session and (args.intra is not None or args.inter is not None):
+        parser.error('%s agent does not use Keras session, --intra and --inter do not take effect' % args.k)
+    grid = {}
+    if keras_session:
+        grid['intra_op_threads'] = args.intra if args.intra is not None else [1, 2, 4]
+        grid['inter_op_threads'] = args.inter if args.inter is not None else [1, 2]
+    elif args.omp is None and args.mkl is None:
+        args.omp = [1, 2, 4]
+    if args.omp is not None:
+        grid['omp_threads'] = args.omp
+    if args.mkl is not None:
+        grid['mkl_threads'] = args.mkl
+    results = sweep(args.k, grid, run_args, args.config)
+
+    if args.omp is None and args.mkl is None:
+        print('OpenMP and MKL threads are not swept, library defaults are used')
+    print('%-60s %12s %10s' % ('settings_agent', 'saturation', 'p50, s'))
+    for settings, report in results:
+        if report is None:
+            print('%-60s %12s %10s' % (json.dumps(settings), 'failed', '-'))
+        else:
+            p50 = report['levels'][0]['p50'] if report['levels'] else None
+            print('%-60s %12.2f %10s' % (json.dumps(settings), report['saturation_rps'],
+                                         '%.4f' % p50 if p50 is not None else '-'))
+    if results and results[0][1] is not None:
+        print('Best: %s' % json.dumps(results[0][0]))
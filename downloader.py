@@ -0,0 +1,265 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Size of chunks, in which response bodies are read and part files are written
+CHUNK_SIZE = 1024 * 1024
+
+# Minimal size of one ranged segment, smaller files are downloaded in fewer segments
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Interval of progress readout in seconds
+PROGRESS_INTERVAL = 1.0
+
+MANIFEST_SUFFIX = '.parts.json'
+
+# Number of download attempts, if file on server changes during download
+CHANGED_RETRIES = 2
+
+
+class ResourceChangedError(IOError):
+    """File on server does not match validator of downloaded parts"""
+
+
+def _probe(url):
+    # Returns content length (or None), flag of byte ranges support and validator of file version:
+    # strong ETag or Last-Modified date (None if server sends neither), used in If-Range header
+    request = urllib.request.Request(url, headers={'Range': 'bytes=0-0'})
+    with urllib.request.urlopen(request) as response:
+        etag = response.headers.get('ETag')
+        # Weak ETags can not be used in If-Range
+        validator = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+        content_range = response.headers.get('Content-Range')
+        if response.status == 206 and content_range and '/' in content_range:
+            total = content_range.rsplit('/', 1)[1]
+            return (int(total) if total.isdigit() else None), True, validator
+        length = response.headers.get('Content-Length')
+        return (int(length) if length is not None else None), False, validator
+
+
+def _part_path(path, i):
+    return '%s.part%s' % (path, i)
+
+
+def _remove_parts(path):
+    # Remove part files and manifest of interrupted download
+    manifest_path = path + MANIFEST_SUFFIX
+    if not os.path.isfile(manifest_path):
+        return
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    for i in range(len(manifest.get('segments', []))):
+        if os.path.isfile(_part_path(path, i)):
+            os.remove(_part_path(path, i))
+    os.remove(manifest_path)
+
+
+def _load_segments(path, url, size, validator, segments_num):
+    # Reuse segmentation of interrupted download of the same version of file, otherwise start anew.
+    # Parts are reused only if server sends validator (ETag or Last-Modified) and it is not changed.
+    manifest_path = path + MANIFEST_SUFFIX
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if validator is not None and manifest.get('url') == url and manifest.get('size') == size \
+                and manifest.get('validator') == validator:
+            return manifest['segments']
+        _remove_parts(path)
+    segment_size = -(-size // segments_num)
+    segments = [[start, min(start + segment_size, size)] for start in range(0, size, segment_size)]
+    with open(manifest_path, 'w') as f:
+        json.dump({'url': url, 'size': size, 'validator': validator, 'segments': segments}, f)
+    return segments
+
+
+class _Progress:
+    # Thread safe counter of downloaded bytes with periodic readout of progress and throughput
+
+    def __init__(self, total, done, enabled):
+        self.total = total
+        self.done = done
+        self.enabled = enabled
+        self._initial = done
+        self._lock = threading.Lock()
+        self._start_time = time.perf_counter()
+        self._last_print = 0.0
+
+    def add(self, size):
+        with self._lock:
+            self.done += size
+            now = time.perf_counter()
+            if self.enabled and now - self._last_print >= PROGRESS_INTERVAL:
+                self._last_print = now
+                self.print(now)
+
+    def print(self, now=None, end=''):
+        now = now if now is not None else time.perf_counter()
+        speed = (self.done - self._initial) / max(now - self._start_time, 1e-9) / 1024 / 1024
+        if self.total:
+            sys.stdout.write('\r%.1f / %.1f MB (%.1f%%), %.1f MB/s' % (self.done / 1024 / 1024,
+                                                                      self.total / 1024 / 1024,
+                                                                      100.0 * self.done / self.total, speed))
+        else:
+            sys.stdout.write('\r%.1f MB, %.1f MB/s' % (self.done / 1024 / 1024, speed))
+        sys.stdout.write(end)
+        sys.stdout.flush()
+
+
+def _download_segment(url, validator, part_path, start, end, progress):
+    # Append bytes [start + downloaded, end) of url to part file. With If-Range server sends the range only
+    # if file version matches validator, otherwise it sends the whole file with status 200
+    offset = start + (os.path.getsize(part_path) if os.path.isfile(part_path) else 0)
+    if offset >= end:
+        return
+    headers = {'Range': 'bytes=%s-%s' % (offset, end - 1)}
+    if validator is not None:
+        headers['If-Range'] = validator
+    request = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(request) as response:
+        if response.status != 206:
+            if validator is not None:
+                raise ResourceChangedError('%s changed on server during download' % url)
+            raise IOError('Server ignored range request for %s' % url)
+        with open(part_path, 'ab') as f:
+            while True:
+                chunk = response.read(min(CHUNK_SIZE, end - offset))
+                if not chunk:
+                    break
+                f.write(chunk)
+                offset += len(chunk)
+                progress.add(len(chunk))
+    if offset != end:
+        raise IOError('Incomplete segment %s-%s of %s: got %s bytes' % (start, end, url, offset - start))
+
+
+def _download_single(url, path, progress):
+    # Download url in one request, resume is not possible without byte ranges support
+    part_path = _part_path(path, 0)
+    with urllib.request.urlopen(url) as response, open(part_path, 'wb') as f:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+            progress.add(len(chunk))
+    os.replace(part_path, path)
+
+
+def file_sha256(path):
+    """Returns hex digest of SHA-256 of file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _download_ranged(url, path, size, validator, workers_num, show_progress):
+    # Download url in parallel segments to part files, continuing interrupted download, and join them
+    segments_num = max(1, min(workers_num, size // MIN_SEGMENT_SIZE))
+    segments = _load_segments(path, url, size, validator, segments_num)
+    done = sum(min(os.path.getsize(_part_path(path, i)), end - start)
+               for i, (start, end) in enumerate(segments) if os.path.isfile(_part_path(path, i)))
+    progress = _Progress(size, done, show_progress)
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [executor.submit(_download_segment, url, validator, _part_path(path, i), start, end, progress)
+                       for i, (start, end) in enumerate(segments)]
+            for future in futures:
+                future.result()
+    finally:
+        if show_progress:
+            progress.print(end='\n')
+
+    # Join part files
+    with open(path + '.tmp', 'wb') as f:
+        for i in range(len(segments)):
+            with open(_part_path(path, i), 'rb') as part:
+                shutil.copyfileobj(part, f, CHUNK_SIZE)
+    os.replace(path + '.tmp', path)
+    _remove_parts(path)
+
+
+def download(url, path, workers_num=4, sha256=None, show_progress=True):
+    """Download file by URL with parallel HTTP range requests, resuming interrupted download
+
+    Args:
+        :param url: URL of file
+        :type url: str
+        :param path: path to save file to
+        :type path: str
+        :param workers_num: number of parallel range requests
+        :type workers_num: int
+        :param sha256: expected hex digest of SHA-256 of file, not verified if empty
+        :type sha256: str
+        :param show_progress: flag, turns off/on progress and throughput readout
+        :type show_progress: bool
+    Returns:
+        :return: path of downloaded file
+        :rtype: str
+    File is split to segments, downloaded to part files (path.part0, path.part1, ...) and joined after all
+    segments are downloaded. If download is interrupted, next call with the same URL and path continues
+    from part files, if server sends ETag or Last-Modified validator of file version and it is not changed;
+    segments are requested with If-Range header, so parts of changed file are discarded and download starts
+    anew. Servers without byte ranges support are downloaded in one request.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    for attempt in range(CHANGED_RETRIES):
+        size, ranges_supported, validator = _probe(url)
+        if not ranges_supported or not size:
+            progress = _Progress(size, 0, show_progress)
+            try:
+                _download_single(url, path, progress)
+            finally:
+                if show_progress:
+                    progress.print(end='\n')
+            break
+        try:
+            _download_ranged(url, path, size, validator, workers_num, show_progress)
+            break
+        except ResourceChangedError:
+            _remove_parts(path)
+            if attempt == CHANGED_RETRIES - 1:
+                raise
+
+    if sha256:
+        digest = file_sha256(path)
+        if digest != sha256.lower():
+            os.remove(path)
+            raise ValueError('Checksum mismatch for %s: expected %s, got %s' % (url, sha256, digest))
+    return path
+
+
+if __name__ == '__main__':
+    # Usage: python downloader.py <url> <path> [-w workers] [--sha256 digest]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url', type=str)
+    parser.add_argument('path', type=str)
+    parser.add_argument('-w', type=int, action='store', dest='w', default=4)
+    parser.add_argument('--sha256', type=str, action='store', dest='sha256', default=None)
+    args = parser.parse_args()
+    download(args.url, args.path, args.w, args.sha256)
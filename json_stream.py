@@ -0,0 +1,187 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import codecs
+import json
+
+
+# Size of chunks read from the response bytes stream
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER_CHARS = '0123456789.eE+-'
+
+
+def iter_object(chunks, stream_key):
+    """Incrementally decode JSON object from stream of bytes chunks
+
+    Args:
+        :param chunks: iterable of bytes objects with UTF-8 encoded JSON object
+        :type chunks: iterable
+        :param stream_key: key of top level array, which items are yielded one by one
+        :type stream_key: str
+    Returns:
+        :return: generator of tuples ('field', key, value) for top level fields
+            and ('item', stream_key, value) for each item of stream_key array
+        :rtype: generator
+    Only one item (or top level field value) is decoded from the text buffer at a time, so neither the whole
+    response text nor the whole stream_key array are held in memory by the decoder.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+
+    def read_more():
+        # Read at least as many characters as are pending in the buffer, so retries of
+        # incomplete values decoding take linear time in total
+        nonlocal buf, pos, eof
+        if eof:
+            raise ValueError('Unexpected end of JSON stream')
+        pending = len(buf) - pos
+        parts = [buf[pos:]]
+        read = 0
+        while not eof and read <= pending:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+                parts.append(text_decoder.decode(b'', final=True))
+            else:
+                text = text_decoder.decode(chunk)
+                parts.append(text)
+                read += len(text)
+        buf = ''.join(parts)
+        pos = 0
+
+    def next_char():
+        # Skip whitespaces and return next character without consuming it
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            read_more()
+
+    def expect(chars):
+        nonlocal pos
+        char = next_char()
+        if char not in chars:
+            raise ValueError('Expected one of %r at JSON stream position, got %r' % (chars, char))
+        pos += 1
+        return char
+
+    def decode_value():
+        nonlocal pos
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                read_more()
+                continue
+            if not eof and (end == len(buf) or buf[end] in _NUMBER_CHARS):
+                # Value (number) may continue in the next chunk
+                read_more()
+                continue
+            pos = end
+            return value
+
+    expect('{')
+    if next_char() == '}':
+        return
+    while True:
+        key = decode_value()
+        expect(':')
+        if key == stream_key and next_char() == '[':
+            pos += 1
+            if next_char() == ']':
+                pos += 1
+            else:
+                while True:
+                    yield 'item', key, decode_value()
+                    if expect(',]') == ']':
+                        break
+        else:
+            yield 'field', key, decode_value()
+        if expect(',}') == '}':
+            return
+
+
+def iter_items(events):
+    """Select stream array items from iter_object events
+
+    Args:
+        :param events: iterable of ('field', key, value) and ('item', key, value) tuples, yielded by iter_object
+        :type events: iterable
+    Returns:
+        :return: generator of stream array items, top level fields are skipped
+        :rtype: generator
+    """
+    for event, _, value in events:
+        if event == 'item':
+            yield value
+
+
+def load(chunks, stream_key):
+    """Decode JSON object from stream of bytes chunks
+
+    Args:
+        :param chunks: iterable of bytes objects with UTF-8 encoded JSON object
+        :type chunks: iterable
+        :param stream_key: key of top level array, which is decoded item by item
+        :type stream_key: str
+    Returns:
+        :return: dict object with decoded JSON
+        :rtype: dict
+    """
+    obj = {}
+    for event, key, value in iter_object(chunks, stream_key):
+        if event == 'item':
+            obj.setdefault(key, []).append(value)
+        else:
+            obj[key] = value
+    obj.setdefault(stream_key, [])
+    return obj
+
+
+def iter_encode(obj, chunk_size=CHUNK_SIZE):
+    """Incrementally encode object to JSON
+
+    Args:
+        :param obj: JSON serializable object
+        :type obj: dict
+        :param chunk_size: approximate size of yielded chunks in characters
+        :type chunk_size: int
+    Returns:
+        :return: generator of bytes objects with UTF-8 encoded JSON
+        :rtype: generator
+    Suitable for the data of chunked POST request: the whole JSON text is never built in memory.
+    """
+    parts = []
+    size = 0
+    for part in json.JSONEncoder().iterencode(obj):
+        parts.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+            size = 0
+    if parts:
+        yield ''.join(parts).encode('utf-8')
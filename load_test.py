@@ -0,0 +1,226 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import observation_utils as ou
+
+
+# Share of sent load, below which achieved throughput is considered saturated
+SATURATION_SHARE = 0.95
+
+
+def getopts(argv):
+    """Returns dict with parsed load test command line arguments and list of the rest arguments
+
+    Args:
+        :param argv: set of raw command line arguments following 'load' command
+        :type argv: list
+    Returns:
+        :return: tuple with dict of load test parameters and list of not parsed arguments (KPI test parameters)
+        :rtype: tuple
+    """
+    parser = argparse.ArgumentParser(prog='run_test.py load')
+    parser.add_argument('--rates', type=str, action='store', dest='rates', default='1,2,5,10,20',
+                        help='comma separated offered loads, requests per second')
+    parser.add_argument('--duration', type=float, action='store', dest='duration', default=30.0,
+                        help='duration of each load level in seconds')
+    parser.add_argument('--concurrency', type=int, action='store', dest='concurrency', default=8,
+                        help='maximal number of requests in flight')
+    parser.add_argument('--request-size', type=int, action='store', dest='request_size', default=1,
+                        help='number of observations in one request')
+    parser.add_argument('--arrivals', type=str, action='store', dest='arrivals', default='poisson',
+                        choices=['poisson', 'uniform'])
+    parser.add_argument('--tasks-file', type=str, action='store', dest='tasks_file', default=None,
+                        help='recorded tasks JSON, tasks are fetched from KPI rest_url if not set')
+    parser.add_argument('--record', type=str, action='store', dest='record', default=None,
+                        help='path to save fetched tasks JSON for replay')
+    parser.add_argument('--report', type=str, action='store', dest='report', default=None,
+                        help='path to save JSON report')
+    parser.add_argument('--seed', type=int, action='store', dest='seed', default=0)
+    args, rest = parser.parse_known_args(argv)
+    opt = vars(args)
+    opt['rates'] = [float(rate) for rate in args.rates.split(',')]
+    return opt, rest
+
+
+def split_requests(observations, request_size):
+    """Split observations set to requests
+
+    Args:
+        :param observations: list, ObservationBatch or (KPI11) dict object with observations
+        :param request_size: number of observations in one request
+        :type request_size: int
+    Returns:
+        :return: list of requests, each in format of observations set of the tester
+        :rtype: list
+    """
+    if isinstance(observations, dict):
+        ids = observations['id']
+        return [{'id': ids[i:i + request_size], 'observation': observations['observation'][i:i + request_size]}
+                for i in range(0, len(ids), request_size)]
+    if isinstance(observations, ou.ObservationBatch):
+        return [ou.ObservationBatch(observations.ids[i:i + request_size],
+                                    [observations.text(j) for j in range(i, min(i + request_size, len(observations)))])
+                for i in range(0, len(observations), request_size)]
+    return [observations[i:i + request_size] for i in range(0, len(observations), request_size)]
+
+
+def percentile(sorted_values, share):
+    """Returns percentile of sorted values (nearest rank)
+    """
+    if not sorted_values:
+        return None
+    rank = min(len(sorted_values) - 1, max(0, int(round(share * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def run_level(predict, requests, rate, duration, concurrency, arrivals, rng):
+    """Replay requests at one offered load level with open-loop arrivals
+
+    Args:
+        :param predict: function, which processes one request
+        :type predict: function
+        :param requests: list of requests, replayed in cycle
+        :type requests: list
+        :param rate: offered load, requests per second
+        :type rate: float
+        :param duration: duration of load level in seconds
+        :type duration: float
+        :param concurrency: maximal number of requests in flight, the rest are queued
+        :type concurrency: int
+        :param arrivals: 'poisson' or 'uniform' inter-arrival times
+        :type arrivals: str
+        :param rng: random numbers generator
+        :type rng: random.Random
+    Returns:
+        :return: dict object with offered and achieved load, latency percentiles (seconds) and errors number
+        :rtype: dict
+    Requests are sent at scheduled times independently of completion of previous ones, latency of request
+    is measured from its scheduled time, so queueing delay under overload is included.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def execute(request, scheduled_time):
+        try:
+            predict(request)
+        except Exception:
+            with lock:
+                errors[0] += 1
+            return
+        finish_time = time.perf_counter()
+        with lock:
+            latencies.append(finish_time - scheduled_time)
+            last_finish[0] = max(last_finish[0], finish_time)
+
+    start_time = time.perf_counter()
+    last_finish = [start_time]
+    scheduled = 0.0
+    sent = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            scheduled += rng.expovariate(rate) if arrivals == 'poisson' else 1.0 / rate
+            if scheduled > duration:
+                break
+            delay = start_time + scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(execute, requests[sent % len(requests)], start_time + scheduled)
+            sent += 1
+
+    latencies.sort()
+    elapsed = max(last_finish[0] - start_time, duration)
+    return {'offered_rps': rate,
+            'sent': sent,
+            'sent_rps': sent / duration,
+            'completed': len(latencies),
+            'errors': errors[0],
+            'achieved_rps': len(latencies) / elapsed,
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None}
+
+
+def run(tester, opt):
+    """Run load test of initialised tester agent and print latency under load table
+
+    Args:
+        :param tester: Tester object for KPI under test with initialised agent
+        :type tester: Tester
+        :param opt: dict object with load test parameters (see getopts)
+        :type opt: dict
+    Returns:
+        :return: dict object with load levels results and saturation throughput
+        :rtype: dict
+    Agent is not thread safe, so requests are processed by agent one at a time: concurrency limits requests
+    in flight, while the rest wait in queue. Prediction cache is turned off for the load test.
+    """
+    if opt['tasks_file'] is not None:
+        with open(opt['tasks_file']) as f:
+            tasks = json.load(f)
+    else:
+        tasks = tester._get_tasks()
+        if opt['record'] is not None:
+            with open(opt['record'], 'w') as f:
+                json.dump(tasks, f)
+    observations = tester._make_observations(tasks)
+    requests = split_requests(observations, opt['request_size'])
+    observations_num = len(observations['id'] if isinstance(observations, dict) else observations)
+    print('Load test of %s: %s observations in %s requests' % (tester.kpi_name, observations_num, len(requests)))
+
+    prediction_cache = tester.prediction_cache
+    tester.prediction_cache = None
+    agent_lock = threading.Lock()
+
+    def predict(request):
+        with agent_lock:
+            tester._get_predictions(request)
+
+    rng = random.Random(opt['seed'])
+    levels = []
+    try:
+        print('%10s %10s %10s %8s %10s %10s %10s %10s' % ('offered', 'achieved', 'completed', 'errors',
+                                                          'p50, s', 'p90, s', 'p99, s', 'max, s'))
+        for rate in opt['rates']:
+            level = run_level(predict, requests, rate, opt['duration'], opt['concurrency'], opt['arrivals'], rng)
+            levels.append(level)
+            print('%10.2f %10.2f %10d %8d %10s %10s %10s %10s'
+                  % (level['offered_rps'], level['achieved_rps'], level['completed'], level['errors'],
+                     *['%.4f' % level[key] if level[key] is not None else '-' for key in ['p50', 'p90', 'p99', 'max']]))
+    finally:
+        tester.prediction_cache = prediction_cache
+
+    # Achieved throughput is compared with actually sent load, which differs from offered one by arrivals randomness
+    saturated = [level for level in levels if level['achieved_rps'] < SATURATION_SHARE * level['sent_rps']]
+    report = {'kpi_name': tester.kpi_name,
+              'request_size': opt['request_size'],
+              'concurrency': opt['concurrency'],
+              'levels': levels,
+              'saturation_rps': max([level['achieved_rps'] for level in levels] or [0.0]),
+              'saturated_at_rps': saturated[0]['offered_rps'] if saturated else None}
+    print('Saturation throughput: %.2f requests/s (%.2f observations/s), saturated at offered load: %s'
+          % (report['saturation_rps'], report['saturation_rps'] * opt['request_size'], report['saturated_at_rps']))
+    if opt['report'] is not None:
+        with open(opt['report'], 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
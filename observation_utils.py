@@ -0,0 +1,155 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from array import array
+
+
+def dedup_observations(observations, text=None):
+    """Collapse observations with identical text to one observation
+
+    Args:
+        :param observations: list or ObservationBatch object containing observations in format, compatible
+            with agent API
+        :type observations: list
+        :param text: function, which returns text of observation, by default observation['text'] is used
+        :type text: function
+    Returns:
+        :return: tuple with list of unique observations (first occurrences) and list with index
+            of unique observation for each of initial observations
+        :rtype: tuple
+    """
+    if text is None:
+        text = lambda observation: observation['text']
+    unique_observations = []
+    unique_indexes = {}
+    observations_index = []
+    for observation in observations:
+        key = text(observation)
+        index = unique_indexes.get(key)
+        if index is None:
+            index = len(unique_observations)
+            unique_indexes[key] = index
+            unique_observations.append(observation)
+        observations_index.append(index)
+    return unique_observations, observations_index
+
+
+def fanout_predictions(predictions, observations_index, ids):
+    """Expand predictions on unique observations back to all initial observations
+
+    Args:
+        :param predictions: list object containing predictions on unique observations
+        :type predictions: list
+        :param observations_index: list with index of unique observation for each of initial observations
+        :type observations_index: list
+        :param ids: list of initial observations ids
+        :type ids: list
+    Returns:
+        :return: list object containing predictions in order of initial observations
+        :rtype: list
+    Predictions are shared between duplicated observations, prediction id (if any) is set to observation id.
+    """
+    fanned_predictions = []
+    for obs_id, index in zip(ids, observations_index):
+        prediction = predictions[index]
+        if isinstance(prediction, dict) and prediction.get('id', obs_id) != obs_id:
+            prediction = dict(prediction, id=obs_id)
+        fanned_predictions.append(prediction)
+    return fanned_predictions
+
+
+class ObservationBatch:
+    """Compact storage of observations set: ids and texts kept in one text buffer with offsets
+
+    Properties:
+        ids: list of observations ids
+
+    Observations are materialised as dicts in format, compatible with agent API, only when accessed:
+    iteration yields observations one by one, indexing by slice returns list of observations.
+    Texts may have shared prefixes (e.g. SQuAD paragraph context, common for several questions),
+    which are stored once.
+    """
+
+    __slots__ = ('ids', '_buffer', '_offsets', '_prefixes', '_prefix_index')
+
+    def __init__(self, ids, texts, prefixes=None, prefix_index=None):
+        """ObservationBatch class constructor
+
+        :param ids: list of observations ids
+        :type ids: list
+        :param texts: iterable of observations texts (without prefixes)
+        :type texts: iterable
+        :param prefixes: list of shared texts prefixes
+        :type prefixes: list
+        :param prefix_index: iterable with index of prefix for each observation
+        :type prefix_index: iterable
+        """
+        self.ids = ids
+        texts = list(texts)
+        offsets = array('q', [0])
+        offset = 0
+        for text in texts:
+            offset += len(text)
+            offsets.append(offset)
+        self._buffer = ''.join(texts)
+        self._offsets = offsets
+        self._prefixes = prefixes
+        self._prefix_index = array('l', prefix_index) if prefixes is not None else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def text(self, i):
+        """Returns text of i-th observation
+
+        Args:
+            :param i: index of observation
+            :type i: int
+        Returns:
+            :return: string with observation text
+            :rtype: str
+        """
+        text = self._buffer[self._offsets[i]:self._offsets[i + 1]]
+        if self._prefixes is not None:
+            text = self._prefixes[self._prefix_index[i]] + text
+        return text
+
+    def take(self, indexes):
+        """Returns ObservationBatch with observations of given indexes, sharing texts prefixes with this one
+
+        Args:
+            :param indexes: list of observations indexes
+            :type indexes: list
+        Returns:
+            :return: ObservationBatch object with selected observations in order of indexes
+            :rtype: ObservationBatch
+        """
+        texts = (self._buffer[self._offsets[i]:self._offsets[i + 1]] for i in indexes)
+        prefix_index = [self._prefix_index[i] for i in indexes] if self._prefixes is not None else None
+        return ObservationBatch([self.ids[i] for i in indexes], texts, self._prefixes, prefix_index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        return {'id': self.ids[key], 'text': self.text(key)}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return repr(list(self))
@@ -0,0 +1,228 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import glob
+import hashlib
+import pickle
+import tempfile
+import unicodedata
+from collections import OrderedDict
+
+
+def get_model_version(model_files, model_variant=''):
+    """Returns fingerprint of model files, which changes when any of model files changes
+
+    Args:
+        :param model_files: list of model files paths (full paths or beginning masks)
+        :type model_files: list
+        :param model_variant: string with description of the way model files are used by agent
+        :type model_variant: str
+    Returns:
+        :return: hex digest of model variant and model files names, sizes and modification times
+        :rtype: str
+    """
+    version = hashlib.sha1()
+    version.update(('%s\n' % model_variant).encode())
+    for model_file in sorted(model_files):
+        for path in sorted(glob.glob(model_file + '*')):
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                version.update(('%s:%s:%s\n' % (os.path.basename(path), stat.st_size, stat.st_mtime_ns)).encode())
+    return version.hexdigest()
+
+
+def create_cache(config, kpi_name, model_files, model_variant='', embedding_file=None):
+    """Returns PredictionCache object for KPI agent if cache is turned on in config, otherwise None
+
+    Args:
+        :param config: dict object initialised with config.json
+        :type config: dict
+        :param kpi_name: string with KPI name
+        :type kpi_name: str
+        :param model_files: list of model files paths of KPI agent
+        :type model_files: list
+        :param model_variant: string with description of the way model files are used by agent
+        :type model_variant: str
+        :param embedding_file: path of embeddings file used by agent, it is a part of model version
+        :type embedding_file: str
+    Returns:
+        :return: PredictionCache object or None
+        :rtype: PredictionCache
+    Persisted cache file name contains model version, so caches of different models do not overwrite each other.
+    """
+    cache_size = int(config.get('prediction_cache_size', 0))
+    if cache_size <= 0:
+        return None
+    fingerprinted_files = list(model_files) + ([embedding_file] if embedding_file else [])
+    model_version = get_model_version(fingerprinted_files, model_variant)
+    cache_path = None
+    if config.get('prediction_cache_persist', 0):
+        cache_path = os.path.join(config['cache_dir'], '%s_predictions_%s.pkl' % (kpi_name, model_version[:16]))
+    return PredictionCache(cache_size, model_version, cache_path)
+
+
+class PredictionCache:
+    """Bounded LRU cache of agent predictions keyed by content hash of observations
+
+    Properties:
+        max_size: integer with maximum number of cached predictions
+        model_version: string with fingerprint of model files, cached predictions are valid only for it
+        path: string with path of cache file on disk or None if cache is not persisted
+        hits: integer with number of observations, served from cache since cache creation
+        misses: integer with number of observations, processed by agent since cache creation
+
+    Public methods:
+        batch_act(self, act, observations, text=None): returns predictions, processing only not cached observations
+        start_run(self): starts counting of cache metrics of testing run
+        stats(self): returns dict with cache metrics of testing run
+        save(self): saves cache to disk if cache path is set
+    """
+
+    def __init__(self, max_size, model_version, path=None):
+        """PredictionCache class constructor
+
+        :param max_size: integer with maximum number of cached predictions
+        :type max_size: int
+        :param model_version: string with fingerprint of model files
+        :type model_version: str
+        :param path: string with path of cache file on disk
+        :type path: str
+        """
+        self.max_size = max_size
+        self.model_version = model_version
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._run_hits = 0
+        self._run_misses = 0
+        self._entries = OrderedDict()
+        if path is not None:
+            self._load()
+
+    def _key(self, text):
+        """Returns cache key: hash of normalised observation text and model version
+        """
+        text = unicodedata.normalize('NFC', text).strip()
+        return hashlib.sha1(('%s\n%s' % (self.model_version, text)).encode()).digest()
+
+    def _load(self):
+        """Load cached predictions from disk, drop them if they were made by other model version
+        """
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        if state['model_version'] == self.model_version:
+            self._entries = state['entries']
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """Save cached predictions to disk if cache path is set
+
+        Cache is written to unique temporary file in cache directory and atomically renamed, so concurrent
+        saves of several processes do not corrupt cache file (the last save wins).
+        """
+        if self.path is None:
+            return
+        cache_dir = os.path.dirname(self.path)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=os.path.basename(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'model_version': self.model_version, 'entries': self._entries}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def batch_act(self, act, observations, text=None):
+        """Returns predictions on observations, processing with agent only observations missing in cache
+
+        Args:
+            :param act: function, which takes list of observations and returns list of predictions
+            :type act: function
+            :param observations: list or ObservationBatch object containing observations in format,
+                compatible with agent API
+            :type observations: list
+            :param text: function, which returns text of observation, by default observation['text'] is used
+            :type text: function
+        Returns:
+            :return: list object containing predictions in raw agent format in order of observations
+            :rtype: list
+        Observations of ObservationBatch are not materialised as dicts: keys are computed from its texts
+        and missed observations are passed to act as ObservationBatch.
+        """
+        compact = hasattr(observations, 'take')
+        if compact:
+            texts = (observations.text(i) for i in range(len(observations)))
+        else:
+            if text is None:
+                text = lambda observation: observation['text']
+            texts = (text(observation) for observation in observations)
+        predictions = []
+        missed_keys = []
+        missed_indexes = []
+        for i, observation_text in enumerate(texts):
+            key = self._key(observation_text)
+            prediction = self._entries.get(key)
+            if prediction is None:
+                missed_keys.append(key)
+                missed_indexes.append(i)
+            else:
+                self._entries.move_to_end(key)
+                if isinstance(prediction, dict) and 'id' in prediction:
+                    if compact:
+                        prediction = dict(prediction, id=observations.ids[i])
+                    elif 'id' in observations[i]:
+                        prediction = dict(prediction, id=observations[i]['id'])
+            predictions.append(prediction)
+        self.hits += len(predictions) - len(missed_indexes)
+        self.misses += len(missed_indexes)
+
+        if len(missed_indexes) > 0:
+            if compact:
+                missed_observations = observations.take(missed_indexes)
+            else:
+                missed_observations = [observations[i] for i in missed_indexes]
+            for i, key, prediction in zip(missed_indexes, missed_keys, act(missed_observations)):
+                predictions[i] = prediction
+                self._entries[key] = prediction
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return predictions
+
+    def start_run(self):
+        """Start counting of cache metrics of testing run, stats are reported from this point
+        """
+        self._run_hits = self.hits
+        self._run_misses = self.misses
+
+    def stats(self):
+        """Returns dict with cache metrics of testing run
+
+        Returns:
+            :return: dict object with cache size and hits, misses and hit rate since the last start_run call
+            :rtype: dict
+        """
+        hits = self.hits - self._run_hits
+        misses = self.misses - self._run_misses
+        return {'cache_size': len(self._entries),
+                'cache_hits': hits,
+                'cache_misses': misses,
+                'cache_hit_rate': hits / (hits + misses) if hits + misses > 0 else 0.0}
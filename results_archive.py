@@ -0,0 +1,212 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import json
+import hashlib
+import argparse
+import difflib
+from numbers import Number
+
+import numpy as np
+
+
+# Archive kinds: numeric answers (KPI1, KPI2 scores) or text answers (NER, SQuAD, coreference markup)
+KIND_SCORE = 'score'
+KIND_TEXT = 'text'
+
+
+def _hash(text_bytes):
+    return int.from_bytes(hashlib.blake2b(text_bytes, digest_size=8).digest(), 'little')
+
+
+def write_archive(path, answers, meta=None):
+    """Write answers of one testing iteration to columnar archive
+
+    Args:
+        :param path: path of archive directory
+        :type path: str
+        :param answers: dict object with task id -> answer (number or string)
+        :type answers: dict
+        :param meta: dict object with JSON serializable information about iteration (KPI name, session id, score)
+        :type meta: dict
+    Archive is a directory of .npy columns sorted by task id: ids, values (for numeric answers) or utf-8 text
+    buffer with offsets and 64-bit hashes (for text answers). All columns are read memory-mapped.
+    """
+    os.makedirs(path, exist_ok=True)
+    ids = np.array([str(task_id) for task_id in answers.keys()], dtype=str)
+    order = np.argsort(ids, kind='stable')
+    values = list(answers.values())
+    numeric = all(isinstance(value, Number) and not isinstance(value, bool) for value in values)
+
+    np.save(os.path.join(path, 'ids.npy'), ids[order])
+    if numeric:
+        np.save(os.path.join(path, 'values.npy'), np.array(values, dtype=np.float64)[order])
+    else:
+        encoded = [str(values[i]).encode('utf-8') for i in order]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        np.save(os.path.join(path, 'text.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(os.path.join(path, 'hashes.npy'), np.array([_hash(value) for value in encoded], dtype=np.uint64))
+
+    meta = dict(meta or {}, kind=KIND_SCORE if numeric else KIND_TEXT, size=len(ids))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+class Archive:
+    """Memory-mapped columnar archive of answers of one testing iteration
+
+    Properties:
+        meta: dict object with archive information, 'kind' is KIND_SCORE or KIND_TEXT
+        ids: array of task ids, sorted
+        values: array of numeric answers (KIND_SCORE archives)
+        hashes: array of text answers hashes (KIND_TEXT archives)
+
+    Public methods:
+        text(self, i): returns text answer with index i
+    """
+
+    def __init__(self, path):
+        """Archive class constructor
+
+        :param path: path of archive directory
+        :type path: str
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode='r')
+        self.ids = load('ids.npy')
+        self.values = None
+        self.hashes = None
+        self._text = None
+        self._offsets = None
+        if self.meta['kind'] == KIND_SCORE:
+            self.values = load('values.npy')
+        else:
+            self.hashes = load('hashes.npy')
+            self._text = load('text.npy')
+            self._offsets = load('offsets.npy')
+
+    def text(self, i):
+        """Returns text answer with index i
+        """
+        return bytes(self._text[self._offsets[i]:self._offsets[i + 1]]).decode('utf-8')
+
+
+def diff_archives(archive_a, archive_b, tolerance=0.0):
+    """Compare answers of two archives
+
+    Args:
+        :param archive_a: Archive object of base iteration
+        :type archive_a: Archive
+        :param archive_b: Archive object of compared iteration
+        :type archive_b: Archive
+        :param tolerance: maximum absolute difference of numeric answers, which are considered equal
+        :type tolerance: float
+    Returns:
+        :return: dict object with arrays of ids only in a, only in b, changed ids, their indexes in both archives
+            and (for numeric archives) answers deltas
+        :rtype: dict
+    """
+    if archive_a.meta['kind'] != archive_b.meta['kind']:
+        raise ValueError('Archives of different kinds can not be compared: %s, %s'
+                         % (archive_a.meta['kind'], archive_b.meta['kind']))
+    common, index_a, index_b = np.intersect1d(archive_a.ids, archive_b.ids, assume_unique=True,
+                                              return_indices=True)
+    result = {'only_a': np.setdiff1d(archive_a.ids, common, assume_unique=True),
+              'only_b': np.setdiff1d(archive_b.ids, common, assume_unique=True),
+              'common': len(common)}
+    if archive_a.meta['kind'] == KIND_SCORE:
+        values_a = archive_a.values[index_a]
+        values_b = archive_b.values[index_b]
+        deltas = values_b - values_a
+        changed = np.abs(deltas) > tolerance
+        result['deltas'] = deltas[changed]
+    else:
+        changed = archive_a.hashes[index_a] != archive_b.hashes[index_b]
+    result['changed'] = common[changed]
+    result['index_a'] = index_a[changed]
+    result['index_b'] = index_b[changed]
+    return result
+
+
+def markup_diff(text_a, text_b):
+    """Returns token level difference of two markup strings (NER tags, coreference columns, answers)
+
+    Args:
+        :param text_a: base markup
+        :type text_a: str
+        :param text_b: compared markup
+        :type text_b: str
+    Returns:
+        :return: list of strings describing changed token positions: 'position: a -> b'
+        :rtype: list
+    Markups of the same length (tags of the same tokens) are compared position by position, so tag substitution
+    is reported as one change. Sequence alignment is used only when tokens were inserted or deleted.
+    """
+    tokens_a = text_a.split(' ')
+    tokens_b = text_b.split(' ')
+    if len(tokens_a) == len(tokens_b):
+        return ['%s: %s -> %s' % (i, token_a, token_b)
+                for i, (token_a, token_b) in enumerate(zip(tokens_a, tokens_b)) if token_a != token_b]
+    changes = []
+    matcher = difflib.SequenceMatcher(a=tokens_a, b=tokens_b, autojunk=False)
+    for tag, a_start, a_end, b_start, b_end in matcher.get_opcodes():
+        if tag != 'equal':
+            changes.append('%s: %s -> %s' % (a_start, ' '.join(tokens_a[a_start:a_end]),
+                                             ' '.join(tokens_b[b_start:b_end])))
+    return changes
+
+
+def diff_main(argv):
+    """Compare two archives and print changed tasks
+
+    Args:
+        :param argv: set of raw command line arguments: archive paths, [-n limit] [--tolerance value]
+        :type argv: list
+    """
+    parser = argparse.ArgumentParser(prog='run_test.py diff')
+    parser.add_argument('archive_a', type=str)
+    parser.add_argument('archive_b', type=str)
+    parser.add_argument('-n', type=int, action='store', dest='n', default=20,
+                        help='number of changed tasks to print')
+    parser.add_argument('--tolerance', type=float, action='store', dest='tolerance', default=0.0)
+    args = parser.parse_args(argv)
+
+    archive_a = Archive(args.archive_a)
+    archive_b = Archive(args.archive_b)
+    diff = diff_archives(archive_a, archive_b, args.tolerance)
+
+    print('score a: %s' % archive_a.meta.get('score'))
+    print('score b: %s' % archive_b.meta.get('score'))
+    print('tasks: a %s, b %s, common %s, only in a %s, only in b %s'
+          % (len(archive_a.ids), len(archive_b.ids), diff['common'], len(diff['only_a']), len(diff['only_b'])))
+    print('changed: %s' % len(diff['changed']))
+    if 'deltas' in diff and len(diff['deltas']) > 0:
+        print('deltas: mean %.6f, mean abs %.6f, min %.6f, max %.6f' % (diff['deltas'].mean(),
+                                                                       np.abs(diff['deltas']).mean(),
+                                                                       diff['deltas'].min(),
+                                                                       diff['deltas'].max()))
+    for k in range(min(args.n, len(diff['changed']))):
+        task_id = diff['changed'][k]
+        i, j = diff['index_a'][k], diff['index_b'][k]
+        if 'deltas' in diff:
+            print('%s: %s -> %s (%+.6f)' % (task_id, archive_a.values[i], archive_b.values[j], diff['deltas'][k]))
+        else:
+            print('%s:' % task_id)
+            for change in markup_diff(archive_a.text(i), archive_b.text(j)):
+                print('    %s' % change)
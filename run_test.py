@@ -17,13 +17,27 @@ import os
 import shutil
 import json
 import urllib.parse
-import urllib.request
 import tarfile
 import glob
+import fnmatch
 import sys
 import argparse
+import gc
+import multiprocessing
 from datetime import datetime
 
+import test_logger
+import load_test
+import startup_report
+
+
+# Tester object of worker process, created by pool initializer
+_worker_tester = None
+
+# Background writer of tester state logs and id of process it belongs to
+_state_log_writer = None
+_state_log_writer_pid = None
+
 
 def get_model_files(config):
     """Download model files and return path of download directory
@@ -37,6 +51,8 @@ def get_model_files(config):
     If specified in config, function downloads model files from local o remote repository
     and returns path of download directory. If not, model returns path of directory,
     where files, defined in config, where downloaded heretofore.
+    If settings_kpi 'extract_mode' is 'required', only model files, dict files and files matching
+    settings_kpi 'extract_extra' patterns are extracted from the archive.
     """
     kpi_name = config['kpi_name']
     update_models = config['update_models']
@@ -60,17 +76,23 @@ def get_model_files(config):
         if update_models_from_local:
             shutil.copy(model_repo_url, model_download_path)
         else:
-            req = urllib.request.urlopen(model_repo_url)
-            with open(model_download_path, 'w+b') as f:
-                f.write(req.read())
-                f.close()
+            import downloader
+            downloader.download(model_repo_url, model_download_path, config.get('download_workers', 4),
+                                config['kpis'][kpi_name]['settings_kpi'].get('model_sha256'))
         print('Done')
 
         # Extract model files
         print('Extracting model to ' + model_extract_dir + ' ...')
-        tar = tarfile.open(model_download_path, 'r:gz')
-        tar.extractall(path=model_extract_dir)
-        tar.close()
+        if config['kpis'][kpi_name]['settings_kpi'].get('extract_mode', 'full') == 'required':
+            patterns = get_required_members_patterns(config['kpis'][kpi_name])
+            extracted_num, members_num, extracted_size = \
+                extract_required_members(model_download_path, model_extract_dir, patterns)
+            print('Extracted %s of %s archive members, %.1f MB' % (extracted_num, members_num,
+                                                                  extracted_size / 1024 / 1024))
+        else:
+            tar = tarfile.open(model_download_path, 'r:gz')
+            tar.extractall(path=model_extract_dir)
+            tar.close()
         print('Done')
 
         # Delete downloaded model files
@@ -82,6 +104,69 @@ def get_model_files(config):
     return model_extract_dir
 
 
+def get_required_members_patterns(kpi_config):
+    """Returns file name patterns of archive members, required by KPI agent
+
+    Args:
+        :param kpi_config: dict object with KPI settings from config.json
+        :type kpi_config: dict
+    Returns:
+        :return: list of fnmatch patterns of members file names
+        :rtype: list
+    Model files and dict files names are beginning masks (as in get_modelfiles_paths),
+    settings_kpi 'extract_extra' contains additional patterns (e.g. checkpoint files of other names).
+    TensorFlow checkpoints need files besides the named one: for '<prefix>.index' model file its
+    '<prefix>.data-*' shards and '<prefix>.meta' graph are added, and for any checkpoint (also '<name>.ckpt')
+    'checkpoint' state file, which is read by agents restoring the latest checkpoint of model dir.
+    """
+    settings_agent = kpi_config['settings_agent']
+    patterns = []
+    for name in settings_agent['model_files_names']:
+        patterns.append(name + '*')
+        if name.endswith('.index'):
+            prefix = name[:-len('.index')]
+            patterns += [prefix + '.data-*', prefix + '.meta', 'checkpoint']
+        elif '.ckpt' in name:
+            patterns.append('checkpoint')
+    dict_files_names = settings_agent.get('dict_files_names')
+    if dict_files_names:
+        names = [dict_files_names] if isinstance(dict_files_names, str) else list(dict_files_names)
+        patterns += [name + '*' for name in names]
+    patterns += list(kpi_config['settings_kpi'].get('extract_extra', []))
+    return [pattern for i, pattern in enumerate(patterns) if pattern not in patterns[:i]]
+
+
+def extract_required_members(archive_path, extract_dir, patterns):
+    """Extract from tar.gz archive only members with file names matching patterns
+
+    Args:
+        :param archive_path: path of tar.gz archive
+        :type archive_path: str
+        :param extract_dir: path of directory to extract members to
+        :type extract_dir: str
+        :param patterns: list of fnmatch patterns of members file names
+        :type patterns: list
+    Returns:
+        :return: tuple with number of extracted members, number of archive members and extracted size in bytes
+        :rtype: tuple
+    Archive is read sequentially in one pass, not required members are skipped without writing to disk.
+    """
+    counts = {'members': 0, 'extracted': 0, 'size': 0}
+
+    def required_members(tar):
+        for member in tar:
+            counts['members'] += 1
+            if member.isfile() and any(fnmatch.fnmatch(os.path.basename(member.name), pattern)
+                                       for pattern in patterns):
+                counts['extracted'] += 1
+                counts['size'] += member.size
+                yield member
+
+    with tarfile.open(archive_path, 'r|gz') as tar:
+        tar.extractall(path=extract_dir, members=required_members(tar))
+    return counts['extracted'], counts['members'], counts['size']
+
+
 def get_modelfiles_paths(model_dir, model_files):
     """Returns list of paths of model files
 
@@ -132,13 +217,24 @@ def getopts(argv):
     parser.add_argument('-i', type=int, action='store', dest='i', default=None)
     parser.add_argument('-t', type=int, action='store', dest='t', default=None)
     parser.add_argument('-l', action='store_true', dest='l', default=False)
+    parser.add_argument('-w', type=int, action='store', dest='w', default=None,
+                        help='number of worker processes for test iterations; each worker loads its own agent, '
+                             'so model and embeddings memory is multiplied by workers number, and CPU threads '
+                             'not set in settings_agent are split between workers')
+    parser.add_argument('-M', type=str, action='store', dest='M', default=None)
+    parser.add_argument('--startup-report', action='store_true', dest='startup_report', default=False)
+    parser.add_argument('--config', type=str, action='store', dest='config', default='config.json')
     args = parser.parse_args(argv)
     opt = {'kpi_name': args.k,
            'model_files_dir': args.m,
            'embedding_file': args.e,
            'iterations_num': args.i,
            'test_tasks_number': args.t,
-           'log_tester_state': args.l}
+           'log_tester_state': args.l,
+           'workers_num': args.w,
+           'model_dirs': args.M.split(',') if args.M is not None else None,
+           'startup_report': args.startup_report,
+           'config_path': args.config}
     return opt
 
 
@@ -149,9 +245,28 @@ def main(argv):
         :param argv: set of raw command line arguments
         :type argv: list
     Method initialises config dict, downloads model files (if specified in config), initialises model agent
-    and runs specified in config or command line number of testing iterations
+    and runs specified in config or command line number of testing iterations.
+    'diff' command compares two predictions archives: run_test.py diff <archive a> <archive b>
+    -M option with comma separated model files dirs runs all iterations with each of models on the same tasks.
+    'load' command replays KPI tasks against initialised agent at increasing offered loads and reports
+    latency percentiles and saturation throughput: run_test.py load [load options] [test options]
+    --startup-report option prints timings of startup phases and of the slowest imports before testing.
+    -w option runs iterations in worker processes, each with its own agent: memory of agent is multiplied by
+    workers number, so it is an opt-in for hosts with enough memory, which are not saturated by one agent.
+    Heavy modules (numpy, requests, parlai with TensorFlow/Keras) are imported by stages, which need them.
     """
+    if len(argv) > 0 and argv[0] == 'diff':
+        import results_archive
+        results_archive.diff_main(argv[1:])
+        return
+
+    load_opt = None
+    if len(argv) > 0 and argv[0] == 'load':
+        load_opt, argv = load_test.getopts(argv[1:])
+
     opt = getopts(argv)
+    report = startup_report.StartupReport(opt['startup_report'])
+    report.start()
 
     # Initialise environment variables
     print('Reading environment variables...')
@@ -160,9 +275,10 @@ def main(argv):
     opt['datasets_repo_url'] = os.getenv('DATASETS_URL')
 
     # Read config.json
-    print('Reading config.json...')
-    with open('config.json') as config_json:
-        config = json.load(config_json)
+    print('Reading %s...' % opt['config_path'])
+    with report.phase('config read'):
+        with open(opt['config_path']) as config_json:
+            config = json.load(config_json)
 
     data_dir = config['data_dir']
     os.makedirs(os.path.dirname(data_dir), exist_ok=True)
@@ -184,19 +300,46 @@ def main(argv):
     if opt['log_tester_state'] is not None:
         config['log_tester_state'] = opt['log_tester_state']
 
-    # Get model files dir [and update models files]
-    model_files_dir = opt['model_files_dir'] if opt['model_files_dir'] is not None else get_model_files(config)
+    if opt['workers_num'] is not None:
+        config['workers_num'] = opt['workers_num']
 
-    # Get model files list
-    opt['model_files'] = \
-        get_modelfiles_paths(model_files_dir, config['kpis'][kpi_name]['settings_agent']['model_files_names'])
+    with report.phase('tester import'):
+        tester_module = __import__(config['kpis'][kpi_name]['settings_kpi']['tester_file'])
+        tester_class = getattr(tester_module, 'Tester')
 
-    # Execute test
-    tester_module = __import__(config['kpis'][kpi_name]['settings_kpi']['tester_file'])
-    tester_class = getattr(tester_module, 'Tester')
-    tester = tester_class(config, opt)
-    tester.init_agent()
+    # Compare several model variants on the same tasks
+    if opt['model_dirs'] is not None:
+        report.print()
+        run_models_comparison(tester_class, config, opt, opt['model_dirs'])
+        close_state_log_writer()
+        return
+
+    with report.phase('model resolution'):
+        # Get model files dir [and update models files]
+        model_files_dir = opt['model_files_dir'] if opt['model_files_dir'] is not None else get_model_files(config)
+
+        # Get model files list
+        opt['model_files'] = \
+            get_modelfiles_paths(model_files_dir, config['kpis'][kpi_name]['settings_agent']['model_files_names'])
+
+    # Execute test iterations in worker processes, each with its own agent
     iters = config['iterations_num']
+    workers_num = min(int(config.get('workers_num', 1)), iters)
+    if workers_num > 1 and load_opt is None:
+        report.print()
+        run_iterations_parallel(config, opt, iters, workers_num)
+        return
+
+    # Execute test
+    with report.phase('agent creation'):
+        tester = tester_class(config, opt)
+        tester.init_agent()
+    report.print()
+    if getattr(tester, 'load_stats', None):
+        print('%s agent load stats: %s' % (config['kpi_name'], format_stats(tester.load_stats)))
+    if load_opt is not None:
+        load_test.run(tester, load_opt)
+        return
     log_tester_state = config['log_tester_state']
     for _ in range(iters):
         print('Executing %s test...' % config['kpi_name'])
@@ -206,9 +349,167 @@ def main(argv):
         print('%s test finished, tasks number: %s, SCORE: %s' % (config['kpi_name'],
                                                                  str(tester.numtasks),
                                                                  str(tester.score)))
+        if tester.stats:
+            print('%s test stats: %s' % (config['kpi_name'], format_stats(tester.stats)))
 
         # Log tester object state
         log_tester(tester, config, start_time, end_time, log_tester_state)
+    close_state_log_writer()
+
+
+def run_models_comparison(tester_class, config, opt, model_dirs):
+    """Execute KPI test iterations with several model variants on the same tasks sets
+
+    Args:
+        :param tester_class: Tester class of KPI under test
+        :type tester_class: type
+        :param config: dict object initialised with config.json
+        :type config: dict
+        :param opt: dict object with optional agent and KPI testing parameters
+        :type opt: dict
+        :param model_dirs: list of model files dirs, one per model variant
+        :type model_dirs: list
+    Tasks of all iterations are requested and converted to observations once, then each model agent is
+    initialised in turn and tested on these observations, so all variants are scored on identical tasks.
+    Scores of all variants are printed in table after testing.
+    """
+    kpi_name = config['kpi_name']
+    iters = config['iterations_num']
+    model_files_names = config['kpis'][kpi_name]['settings_agent']['model_files_names']
+
+    # Request tasks and make observations with tester without agent
+    tester = tester_class(config, dict(opt, model_files=[]))
+    tasks_sets = []
+    for _ in range(iters):
+        tasks = tester._get_tasks()
+        tasks_sets.append((tasks, tester._make_observations(tasks)))
+    print('%s test: %s tasks sets received for %s models' % (kpi_name, len(tasks_sets), len(model_dirs)))
+
+    scores = []
+    for model_dir in model_dirs:
+        model_opt = dict(opt, model_files_dir=model_dir, model_files=get_modelfiles_paths(model_dir, model_files_names))
+        tester = tester_class(config, model_opt)
+        tester.init_agent()
+        model_scores = []
+        for tasks, observations in tasks_sets:
+            print('Executing %s test with model %s...' % (kpi_name, model_dir))
+            start_time = str(datetime.now())
+            tester.run_test(init_agent=False, tasks=tasks, observations=observations)
+            end_time = str(datetime.now())
+            print('%s test finished, model: %s, tasks number: %s, SCORE: %s' % (kpi_name,
+                                                                               model_dir,
+                                                                               str(tester.numtasks),
+                                                                               str(tester.score)))
+            if tester.stats:
+                print('%s test stats: %s' % (kpi_name, format_stats(tester.stats)))
+            log_tester(tester, config, start_time, end_time, config['log_tester_state'])
+            model_scores.append(tester.score)
+        scores.append(model_scores)
+        # Release model agent before initialising the next one
+        tester = None
+        gc.collect()
+
+    print('%s test scores by models:' % kpi_name)
+    for model_dir, model_scores in zip(model_dirs, scores):
+        print('%s: %s' % (model_dir, ', '.join(str(score) for score in model_scores)))
+
+
+def run_iterations_parallel(config, opt, iters, workers_num):
+    """Execute KPI test iterations in a pool of worker processes
+
+    Args:
+        :param config: dict object initialised with config.json
+        :type config: dict
+        :param opt: dict object with optional agent and KPI testing parameters, including model files
+        :type opt: dict
+        :param iters: number of testing iterations
+        :type iters: int
+        :param workers_num: number of worker processes
+        :type workers_num: int
+    Workers are started with 'spawn' and each of them initialises its own agent. Agents are not initialised
+    in the parent and then forked, as TensorFlow runtime (its thread pools and session state) does not
+    survive fork() and session run in forked child may hang. So each worker holds a full copy of model and
+    embeddings in memory. Iterations results are printed in iterations order.
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=workers_num, initializer=_init_worker,
+                      initargs=(config, opt, workers_num)) as pool:
+        print('Executing %s test in %s workers...' % (config['kpi_name'], workers_num))
+        for iteration, numtasks, score, stats in pool.imap(_run_iteration_worker, range(iters)):
+            print('%s test iteration %s finished, tasks number: %s, SCORE: %s' % (config['kpi_name'],
+                                                                                  iteration,
+                                                                                  str(numtasks),
+                                                                                  str(score)))
+            if stats:
+                print('%s test iteration %s stats: %s' % (config['kpi_name'], iteration, format_stats(stats)))
+
+
+def _init_worker(config, opt, workers_num):
+    """Create Tester object and initialise its agent in worker process
+
+    Args:
+        :param config: dict object initialised with config.json
+        :type config: dict
+        :param opt: dict object with optional agent and KPI testing parameters, including model files
+        :type opt: dict
+        :param workers_num: number of worker processes
+        :type workers_num: int
+    Thread numbers not set in settings_agent are limited to worker's share of CPUs, so workers do not
+    oversubscribe CPU with library default thread pools (one thread per CPU each).
+    """
+    global _worker_tester
+    tester_class = getattr(__import__(config['kpis'][config['kpi_name']]['settings_kpi']['tester_file']), 'Tester')
+    settings_agent = config['kpis'][config['kpi_name']]['settings_agent']
+    worker_threads = max(1, (os.cpu_count() or 1) // workers_num)
+    for key in ['omp_threads', 'mkl_threads']:
+        if not settings_agent.get(key):
+            settings_agent[key] = worker_threads
+    if tester_class.keras_session:
+        if not settings_agent.get('intra_op_threads'):
+            settings_agent['intra_op_threads'] = worker_threads
+        if not settings_agent.get('inter_op_threads'):
+            settings_agent['inter_op_threads'] = 1
+    _worker_tester = tester_class(config, opt)
+    _worker_tester.init_agent()
+    if getattr(_worker_tester, 'load_stats', None):
+        print('%s worker %s agent load stats: %s' % (config['kpi_name'], os.getpid(),
+                                                     format_stats(_worker_tester.load_stats)))
+
+
+def _run_iteration_worker(iteration):
+    """Execute one KPI test iteration in worker process and log its results
+
+    Args:
+        :param iteration: number of testing iteration
+        :type iteration: int
+    Returns:
+        :return: tuple with iteration number, tasks number, test score and tester stats
+        :rtype: tuple
+    """
+    tester = _worker_tester
+    config = tester.config
+    start_time = str(datetime.now())
+    tester.run_test(init_agent=False)
+    end_time = str(datetime.now())
+    log_tester(tester, config, start_time, end_time, config['log_tester_state'])
+    if config['log_tester_state']:
+        # Worker may be terminated after returning result, so state log is written before it
+        get_state_log_writer().wait()
+    return iteration, tester.numtasks, tester.score, tester.stats
+
+
+def format_stats(stats):
+    """Returns string with tester metrics
+
+    Args:
+        :param stats: dict object with metrics of the last testing sequence
+        :type stats: dict
+    Returns:
+        :return: string with comma separated metrics names and values
+        :rtype: str
+    """
+    return ', '.join('%s: %s' % (name, round(value, 4) if isinstance(value, float) else value)
+                     for name, value in stats.items())
 
 
 def log_tester(tester, config, start_time, end_time, log_tester_state):
@@ -225,22 +526,38 @@ def log_tester(tester, config, start_time, end_time, log_tester_state):
         :type end_time: str
         :param log_tester_state: integer flag (0, 1), turns off/on extended tester object state logging
         :type log_tester_state: int
-    Method saves log file after each KPI test iteration into path, specified in config['test_logs_dir']
+    Method saves log file after each KPI test iteration into path, specified in config['test_logs_dir'].
+    Extended tester object state is written in background to compressed JSONL log with per-task records
+    and task id index (see test_logger module). If config['archive_predictions'] is set, answers are saved
+    to columnar archive, which can be compared with 'run_test.py diff'.
     """
-    # Form string with tester object state
+    # Queue structured tester object state log for background writing
     if log_tester_state:
-        tester_state = 'tasks: %s' \
-                       '\nobservations: %s' \
-                       '\npredictions: %s' \
-                       '\nanswers: %s' \
-                       '\nresponse code: %s' % (tester.tasks,
-                                                tester.observations,
-                                                tester.predictions,
-                                                tester.answers,
-                                                tester.response_code)
+        state_log_path = os.path.join(config['test_logs_dir'], '%s_%s_state' % (config['kpi_name'], start_time))
+        header = {'kpi_name': config['kpi_name'],
+                  'session_id': tester.session_id,
+                  'numtasks': tester.numtasks,
+                  'start_time': start_time,
+                  'end_time': end_time,
+                  'score': tester.score,
+                  'response_code': tester.response_code,
+                  'stats': tester.stats}
+        records = test_logger.iter_state_records(header, tester.tasks, tester.observations, tester.predictions,
+                                                 tester.answers)
+        get_state_log_writer().submit(state_log_path, records)
+        tester_state = 'state log: %s%s' % (state_log_path, test_logger.LOG_SUFFIX)
     else:
         tester_state = ''
 
+    # Archive predictions for run-to-run comparison
+    if config.get('archive_predictions', 0):
+        archive_path = os.path.join(config['test_logs_dir'], '%s_%s_archive' % (config['kpi_name'], start_time))
+        import results_archive
+        results_archive.write_archive(archive_path, tester.answers['answers'], {'kpi_name': config['kpi_name'],
+                                                                                'session_id': tester.session_id,
+                                                                                'score': tester.score})
+        tester_state += '\npredictions archive: %s' % archive_path
+
     # Log test results
     log_str = 'testing %s :' \
               '\nsession id: %s' \
@@ -248,12 +565,14 @@ def log_tester(tester, config, start_time, end_time, log_tester_state):
               '\nstart time: %s' \
               '\nend time  : %s' \
               '\nscore: %s' \
+              '\nstats: %s' \
               '\n\n%s' % (config['kpi_name'],
                           tester.session_id,
                           tester.numtasks,
                           start_time,
                           end_time,
                           tester.score,
+                          format_stats(tester.stats),
                           tester_state)
 
     file_path = os.path.join(config['test_logs_dir'], '%s_%s.txt' % (config['kpi_name'], start_time))
@@ -263,5 +582,28 @@ def log_tester(tester, config, start_time, end_time, log_tester_state):
     f.close()
 
 
+def get_state_log_writer():
+    """Returns background writer of tester state logs, created for current process
+
+    Returns:
+        :return: StateLogWriter object
+        :rtype: StateLogWriter
+    """
+    global _state_log_writer, _state_log_writer_pid
+    if _state_log_writer is None or _state_log_writer_pid != os.getpid():
+        _state_log_writer = test_logger.StateLogWriter()
+        _state_log_writer_pid = os.getpid()
+    return _state_log_writer
+
+
+def close_state_log_writer():
+    """Wait for queued tester state logs to be written and stop writer of current process
+    """
+    global _state_log_writer
+    if _state_log_writer is not None and _state_log_writer_pid == os.getpid():
+        _state_log_writer.close()
+    _state_log_writer = None
+
+
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -4,7 +4,7 @@ export EMBEDDINGS_URL="http://lnsigo.mipt.ru/export/"
 export MODELS_URL="http://lnsigo.mipt.ru/export/"
 export DATASETS_URL="http://lnsigo.mipt.ru/export/"
 
-while getopts "k:m:e:i:t:l" option; do
+while getopts "k:m:e:i:t:lw:M:" option; do
 	case "${option}"
 	in
 		k) KPI_NAME="-k $OPTARG";;
@@ -13,7 +13,9 @@ while getopts "k:m:e:i:t:l" option; do
 		i) ITER_NUM="-i $OPTARG";;
 		t) TASKS_NUMBER="-t $OPTARG";;
 		l) LOG_STATE="-l";;
+		w) WORKERS_NUM="-w $OPTARG";;
+		M) MODEL_FOLDERS="-M $OPTARG";;
 	esac
 done
 
-python3 run_test.py $KPI_NAME $MODEL_FOLDER $EMBEDDING_FILE $ITER_NUM $TASKS_NUMBER $LOG_STATE
\ No newline at end of file
+python3 run_test.py $KPI_NAME $MODEL_FOLDER $EMBEDDING_FILE $ITER_NUM $TASKS_NUMBER $LOG_STATE $WORKERS_NUM $MODEL_FOLDERS
\ No newline at end of file
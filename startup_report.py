@@ -0,0 +1,112 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import sys
+import time
+import builtins
+from contextlib import contextmanager
+
+
+# Number of the slowest imports in report
+REPORT_IMPORTS_NUM = 20
+
+
+class StartupReport:
+    """Recorder of startup phases and modules imports timings
+
+    Properties:
+        enabled: bool flag, if not set, recorder does nothing
+        phases: list of tuples with phase name and duration in seconds
+        imports: list of tuples with module name, import time in seconds (including nested imports),
+            nesting level and name of phase, during which module was imported
+
+    Public methods:
+        start(self): starts recording of imports
+        stop(self): stops recording of imports
+        phase(self, name): context manager, which records duration of startup phase
+        print(self): stops recording and prints report
+    """
+
+    def __init__(self, enabled=True):
+        """StartupReport class constructor
+
+        :param enabled: bool flag, turns on/off recording
+        :type enabled: bool
+        """
+        self.enabled = enabled
+        self.phases = []
+        self.imports = []
+        self._start_time = time.perf_counter()
+        self._phase = None
+        self._depth = 0
+        self._original_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # Only the first import of module is timed, repeated imports are dictionary lookups
+        if level != 0 or name in sys.modules:
+            return self._original_import(name, globals, locals, fromlist, level)
+        start_time = time.perf_counter()
+        self._depth += 1
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            self._depth -= 1
+            self.imports.append((name, time.perf_counter() - start_time, self._depth, self._phase))
+
+    def start(self):
+        """Start recording of imports
+        """
+        if self.enabled and self._original_import is None:
+            self._original_import = builtins.__import__
+            builtins.__import__ = self._import
+
+    def stop(self):
+        """Stop recording of imports
+        """
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    @contextmanager
+    def phase(self, name):
+        """Record duration of startup phase
+
+        Args:
+            :param name: phase name
+            :type name: str
+        """
+        if not self.enabled:
+            yield
+            return
+        self._phase = name
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start_time))
+            self._phase = None
+
+    def print(self):
+        """Stop recording and print phases timings and the slowest top level imports
+        """
+        if not self.enabled:
+            return
+        self.stop()
+        print('Startup report, total %.3f s:' % (time.perf_counter() - self._start_time))
+        for name, elapsed in self.phases:
+            print('    phase %-20s %8.3f s' % (name, elapsed))
+        top_imports = sorted((item for item in self.imports if item[2] == 0), key=lambda item: -item[1])
+        for name, elapsed, _, phase in top_imports[:REPORT_IMPORTS_NUM]:
+            print('    import %-30s %8.3f s (%s)' % (name, elapsed, phase or 'startup'))
@@ -0,0 +1,211 @@
+# Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import sys
+import json
+import gzip
+import queue
+import threading
+
+
+# Number of records compressed together into one gzip member of the log file
+BLOCK_RECORDS = 256
+
+LOG_SUFFIX = '.jsonl.gz'
+INDEX_SUFFIX = '.idx.json'
+
+
+def _json_default(obj):
+    # numpy scalars and arrays
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+
+def iter_state_records(header, tasks, observations, predictions, answers):
+    """Returns per-task records of tester state
+
+    Args:
+        :param header: dict object with session information (KPI name, session id, score, times, etc.)
+        :type header: dict
+        :param tasks: dict object initialised with tasks JSON received from the testing system
+        :type tasks: dict
+        :param observations: list, ObservationBatch or (for KPI11) dict object with observations
+        :param predictions: list object containing predictions in raw agent format
+        :type predictions: list
+        :param answers: dict object containing answers JSON payload
+        :type answers: dict
+    Returns:
+        :return: generator of dicts: session record first and then one record per task with task id,
+            task (with its paragraph fields for KPI4), observation, prediction and answer
+        :rtype: generator
+    """
+    header = dict(header, record='session')
+    tasks_by_id = {}
+    if tasks is not None:
+        header['tasks_fields'] = {key: value for key, value in tasks.items() if not isinstance(value, list)}
+        for task in tasks.get('qas', []):
+            if isinstance(task, dict) and 'id' in task:
+                tasks_by_id[task['id']] = task
+        # KPI4 tasks are questions grouped by paragraphs: task record gets paragraph fields (context, etc.)
+        for paragraph in tasks.get('paragraphs', []):
+            paragraph_fields = {key: value for key, value in paragraph.items() if key != 'qas'}
+            for task in paragraph.get('qas', []):
+                if isinstance(task, dict) and 'id' in task:
+                    tasks_by_id[task['id']] = dict(task, paragraph=paragraph_fields)
+    yield header
+
+    if observations is None:
+        return
+    if isinstance(observations, dict):
+        id_observations = zip(observations['id'], observations['observation'])
+    else:
+        id_observations = ((observation['id'], observation) for observation in observations)
+    task_answers = answers.get('answers', {}) if answers is not None else {}
+    predictions = predictions if predictions is not None else []
+    for i, (task_id, observation) in enumerate(id_observations):
+        yield {'record': 'task',
+               'id': task_id,
+               'task': tasks_by_id.get(task_id),
+               'observation': observation,
+               'prediction': predictions[i] if i < len(predictions) else None,
+               'answer': task_answers.get(task_id)}
+
+
+def write_state_log(path, records):
+    """Write records to compressed JSONL log with index of records by task id
+
+    Args:
+        :param path: path of log without suffix, log is written to path + LOG_SUFFIX and index to path + INDEX_SUFFIX
+        :type path: str
+        :param records: iterable of JSON serializable dicts, records with 'id' key are indexed
+        :type records: iterable
+    Log is a sequence of gzip members of BLOCK_RECORDS JSON lines each, so it can be read as ordinary
+    .jsonl.gz file, while index (block offsets and block number and line number of each task id)
+    allows to read single task record decompressing only its block.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    blocks = []
+    ids = {}
+    lines = []
+
+    with open(path + LOG_SUFFIX, 'wb') as f:
+        def write_block():
+            data = gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+            blocks.append([f.tell(), len(data)])
+            f.write(data)
+            lines.clear()
+
+        for record in records:
+            if 'id' in record:
+                ids[str(record['id'])] = [len(blocks), len(lines)]
+            lines.append(json.dumps(record, ensure_ascii=False, default=_json_default))
+            if len(lines) >= BLOCK_RECORDS:
+                write_block()
+        if lines:
+            write_block()
+
+    with open(path + INDEX_SUFFIX, 'w') as f:
+        json.dump({'blocks': blocks, 'ids': ids}, f)
+
+
+def lookup(path, task_id):
+    """Read record of single task from compressed JSONL log
+
+    Args:
+        :param path: path of log without suffix
+        :type path: str
+        :param task_id: task id
+        :type task_id: str
+    Returns:
+        :return: dict object with task record or None if task id is not in log
+        :rtype: dict
+    """
+    with open(path + INDEX_SUFFIX) as f:
+        index = json.load(f)
+    position = index['ids'].get(str(task_id))
+    if position is None:
+        return None
+    block, line = position
+    offset, length = index['blocks'][block]
+    with open(path + LOG_SUFFIX, 'rb') as f:
+        f.seek(offset)
+        data = gzip.decompress(f.read(length))
+    return json.loads(data.decode('utf-8').split('\n')[line])
+
+
+class StateLogWriter:
+    """Background writer of tester state logs
+
+    Public methods:
+        submit(self, path, records): queues records for writing to log at path
+        wait(self): blocks until all queued logs are written
+        close(self): writes queued logs and stops writer thread
+    """
+
+    def __init__(self):
+        """StateLogWriter class constructor, starts writer thread
+        """
+        self._queue = queue.Queue()
+        self._errors = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                write_state_log(*job)
+            except Exception as e:
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, path, records):
+        """Queue records for writing to log
+
+        Args:
+            :param path: path of log without suffix
+            :type path: str
+            :param records: iterable of JSON serializable dicts, iterated in writer thread
+            :type records: iterable
+        Records iterable must not depend on objects, which are modified after submitting.
+        """
+        self._queue.put((path, records))
+
+    def wait(self):
+        """Block until all queued logs are written, raise the first error of writing, if any
+        """
+        self._queue.join()
+        if self._errors:
+            error = self._errors[0]
+            self._errors.clear()
+            raise error
+
+    def close(self):
+        """Write queued logs and stop writer thread
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+
+if __name__ == '__main__':
+    # Usage: python test_logger.py <log path without suffix> <task id>
+    print(json.dumps(lookup(sys.argv[1], sys.argv[2]), ensure_ascii=False, indent=2))
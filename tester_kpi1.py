@@ -14,11 +14,14 @@
 
 
 import os
-import json
-import requests
 
-import build_utils as bu
-from parlai.core.agents import create_agent
+import batch_controller as bc
+import compression as cz
+import cpu_config as cc
+import json_stream as js
+import model_loader as ml
+import prediction_cache as pc
+import observation_utils as ou
 
 
 class Tester:
@@ -26,6 +29,7 @@ class Tester:
 
     Properties:
         agent: KPI's model agent object
+        cascade_agents: list of ensemble members agents objects, used instead of agent in cascade mode
         config: dict object initialised with config.json and modified with run script
         opt: dict object with optional agent and KPI testing parameters
         kpi_name: string with KPI name
@@ -37,14 +41,24 @@ class Tester:
         answers: list object prepared for dumping into JSON payload of POST request according testing the system API
         score: string with result of agent predictions scoring by testing system
         response_code: string with the code of the testing system POST request response
+        prediction_cache: PredictionCache object or None if predictions caching is turned off
+        batch_sizer: AdaptiveBatchSizer object or None if observations batch size is not adaptive
+        stats: dict object with metrics of the last testing sequence
+        load_stats: dict object with metrics of the last agent initialisation
 
     Public methods:
         init_agent(self): initiates model agent
         update_config(self, config, init_agent=False): updates Tester instance config
         set_numtasks(self, numtasks): updates Tester instance tasks number
-        run_test(self, init_agent=True): evokes full cycle of KPI testing sequence with current config and tasks number
+        run_test(self, init_agent=True, tasks=None, observations=None): evokes full cycle of KPI testing sequence with current config and tasks number
     """
 
+    # Agent runs its models in Keras session, so TensorFlow thread pools settings apply to it
+    keras_session = True
+
+    # Ensemble members weights
+    model_coefs = [0.3333333, 0.3333333, 0.3333334]
+
     def __init__(self, config, opt):
         """Tester class constructor
 
@@ -54,6 +68,7 @@ class Tester:
         :type opt: dict
         """
         self.agent = None
+        self.cascade_agents = None
         self.config = config
         self.opt = opt
         self.kpi_name = config['kpi_name']
@@ -66,13 +81,70 @@ class Tester:
         self.answers = None
         self.score = None
         self.response_code = None
+        self.prediction_cache = None
+        self.batch_sizer = None
+        self.stats = {}
+        self.load_stats = {}
 
     def init_agent(self):
         """Initiate model agent
+
+        In cascade mode (settings_kpi 'cascade_mode') each ensemble member is initiated as a separate agent.
+        Each member agent loads its own copy of fasttext embeddings, so cascade mode multiplies memory usage
+        and startup time by members number: both are added to load stats.
+        If settings_agent 'load_workers' is greater than 1, members files are read in parallel before initiation.
+        CPU threads and affinity settings of settings_agent are applied before agent modules import.
         """
+        cpu_settings = cc.apply(self.config['kpis'][self.kpi_name]['settings_agent'], self.keras_session)
+        from parlai.core.agents import create_agent
+        model_files = self.opt['model_files']
+        model_names = self.config['kpis'][self.kpi_name]['settings_agent']['model_names']
+        load_workers = self.config['kpis'][self.kpi_name]['settings_agent'].get('load_workers', 0)
+        if self.config['kpis'][self.kpi_name]['settings_kpi'].get('cascade_mode', 0):
+            self.agent = None
+            self.cascade_agents = []
+            self.load_stats = ml.prefetch_members(model_files, load_workers) if load_workers > 1 else {}
+            for model_file, model_name in zip(model_files, model_names):
+                agent, agent_stats = ml.timed_create_agent(create_agent,
+                                                           self._make_agent_opt([model_file], [model_name], [1.0]),
+                                                           [model_file], 0)
+                self.cascade_agents.append(agent)
+                self.load_stats['create_agent_time %s' % os.path.basename(model_file)] = \
+                    agent_stats['create_agent_time']
+            self.load_stats['cascade_agents'] = len(self.cascade_agents)
+            self.load_stats['rss_mb'] = round(bc.get_rss() / 1024 / 1024, 1)
+            cascade_band = self.config['kpis'][self.kpi_name]['settings_kpi']['cascade_band']
+            model_variant = 'cascade %s %s' % tuple(cascade_band)
+        else:
+            self.cascade_agents = None
+            self.agent, self.load_stats = ml.timed_create_agent(create_agent,
+                                                                self._make_agent_opt(model_files, model_names,
+                                                                                     self.model_coefs),
+                                                                model_files, load_workers)
+            model_variant = ''
+        self.load_stats.update(cpu_settings)
+        self.batch_sizer = bc.create_sizer(self.config['kpis'][self.kpi_name]['settings_kpi'])
+        self.prediction_cache = pc.create_cache(self.config, self.kpi_name, model_files, model_variant,
+                                                self._get_embedding_path())
+
+    def _make_agent_opt(self, model_files, model_names, model_coefs):
+        """Prepare options dict for insults ensemble agent
+
+        Args:
+            :param model_files: list of ensemble members model files paths
+            :type model_files: list
+            :param model_names: list of ensemble members model names
+            :type model_names: list
+            :param model_coefs: list of ensemble members weights
+            :type model_coefs: list
+        Returns:
+            :return: dict object with agent options
+            :rtype: dict
+        """
+        import build_utils as bu
         params = ['-t', 'deeppavlov.tasks.insults.agents:FullTeacher',
             '-m', 'deeppavlov.agents.insults.insults_agents:EnsembleInsultsAgent',
-            '--model_coefs', '0.3333333', '0.3333333', '0.3333334',
+            '--model_coefs'] + [str(coef) for coef in model_coefs] + [
             '--datatype', 'test',
             '--batchsize', '64',
             '--display-examples', 'False',
@@ -81,18 +153,21 @@ class Tester:
             '--kernel_sizes_cnn', '1 2 3',
             '--embedding_dim', '100',
             '--dense_dim', '100']
-        embeddings_dir = self.config['embeddings_dir']
-        embedding_file = self.config['kpis'][self.kpi_name]['settings_agent']['embedding_file']
-        model_files = self.opt['model_files']
         opt = bu.arg_parse(params)
         opt['model_files'] = model_files
-        opt['model_names'] = self.config['kpis'][self.kpi_name]['settings_agent']['model_names']
+        opt['model_names'] = model_names
         opt['raw_dataset_path'] = os.path.dirname(model_files[0])
+        opt['fasttext_model'] = self._get_embedding_path()
+        return opt
+
+    def _get_embedding_path(self):
+        """Returns path of fasttext embeddings file: -e argument of run script or file from config
+        """
         if self.opt['embedding_file'] is not None:
-            opt['fasttext_model'] = self.opt['embedding_file']
-        else:
-            opt['fasttext_model'] = os.path.join(embeddings_dir, embedding_file)
-        self.agent = create_agent(opt)
+            return self.opt['embedding_file']
+        embeddings_dir = self.config['embeddings_dir']
+        embedding_file = self.config['kpis'][self.kpi_name]['settings_agent']['embedding_file']
+        return os.path.join(embeddings_dir, embedding_file)
 
     def update_config(self, config, init_agent=False):
         """Update Tester instance configuration dict
@@ -118,23 +193,67 @@ class Tester:
         """
         self.numtasks = numtasks
 
-    def _get_tasks(self):
-        """Send GET request to testing system and get tasks set
+    def _request_tasks(self):
+        """Send GET request to testing system for tasks set
 
         Returns:
-            :return: dict object initialised with tasks JSON received from the testing system
-            :rtype: dict
+            :return: requests.Response object with not read tasks JSON stream
+            :rtype: requests.Response
         """
+        import requests
         get_url = self.config['kpis'][self.kpi_name]['settings_kpi']['rest_url']
         if self.numtasks in [None, 0]:
             test_tasks_number = self.config['kpis'][self.kpi_name]['settings_kpi']['test_tasks_number']
         else:
             test_tasks_number = self.numtasks
         get_params = {'stage': 'test', 'quantity': test_tasks_number}
-        get_response = requests.get(get_url, params=get_params)
-        tasks = json.loads(get_response.text)
+        get_headers = {}
+        accept_encoding = cz.accept_encoding(self.config['kpis'][self.kpi_name]['settings_kpi'].get('compression', ''))
+        if accept_encoding is not None:
+            get_headers['Accept-Encoding'] = accept_encoding
+        return requests.get(get_url, params=get_params, headers=get_headers, stream=True)
+
+    def _get_tasks(self):
+        """Send GET request to testing system and get tasks set
+
+        Returns:
+            :return: dict object initialised with tasks JSON received from the testing system
+            :rtype: dict
+        """
+        # Decode tasks straight from the response bytes stream, without building the whole response text
+        get_response = self._request_tasks()
+        try:
+            tasks = js.load(cz.iter_content(get_response, js.CHUNK_SIZE), 'qas')
+        finally:
+            get_response.close()
         return tasks
 
+    def _get_tasks_observations(self):
+        """Send GET request to testing system and prepare observation set while tasks are decoded
+
+        Returns:
+            :return: tuple with dict object with tasks top level fields (without tasks themselves)
+                and ObservationBatch object containing observations
+            :rtype: tuple
+        Used when tasks are not logged: each task is decoded from response stream and only its id and
+        observation text are kept, so tasks dicts are never held all together.
+        """
+        tasks = {}
+        ids = []
+        texts = []
+        get_response = self._request_tasks()
+        try:
+            for event, key, task in js.iter_object(cz.iter_content(get_response, js.CHUNK_SIZE), 'qas'):
+                if event == 'item':
+                    ids.append(task['id'])
+                    texts.append(task['question'])
+                else:
+                    tasks[key] = task
+        finally:
+            get_response.close()
+        observations = ou.ObservationBatch(ids, texts)
+        return tasks, observations
+
     def _make_observations(self, tasks):
         """Prepare observation set according agent API
 
@@ -142,15 +261,11 @@ class Tester:
             :param tasks: dict object initialised with tasks JSON received from the testing system
             :type tasks: dict
         Returns:
-            :return: list object containing observations in format, compatible with agent API
-            :rtype: list
+            :return: ObservationBatch object containing observations in format, compatible with agent API
+            :rtype: ObservationBatch
         """
-        observations = []
-        for task in tasks['qas']:
-            observations.append({
-                'id': task['id'],
-                'text': task['question'],
-            })
+        observations = ou.ObservationBatch([task['id'] for task in tasks['qas']],
+                                           (task['question'] for task in tasks['qas']))
         return observations
 
     def _get_predictions(self, observations):
@@ -163,7 +278,102 @@ class Tester:
             :return: list object containing predictions in raw agent format
             :rtype: list
         """
-        predictions = self.agent.batch_act(observations)
+        dedup_observations = self.config['kpis'][self.kpi_name]['settings_kpi'].get('dedup_observations', 0)
+        if dedup_observations:
+            # Process each unique observation text once and share prediction between duplicates
+            unique_observations, observations_index = ou.dedup_observations(observations)
+            self.stats['observations'] = len(observations)
+            self.stats['unique_observations'] = len(unique_observations)
+        else:
+            unique_observations = list(observations)
+
+        if self.prediction_cache is not None:
+            predictions = self.prediction_cache.batch_act(self._batch_act, unique_observations)
+        else:
+            predictions = self._batch_act(unique_observations)
+
+        if dedup_observations:
+            predictions = ou.fanout_predictions(predictions, observations_index, observations.ids)
+        return predictions
+
+    def _batch_act(self, observations):
+        """Process observations with agent's model, in batches of adaptive size if batch sizer is configured
+
+        Args:
+            :param observations: list object containing observations in format, compatible with agent API
+            :type observations: list
+        Returns:
+            :return: list object containing predictions in raw agent format
+            :rtype: list
+        """
+        batch_act = self._cascade_batch_act if self.cascade_agents is not None else self.agent.batch_act
+        if self.batch_sizer is not None:
+            predictions = bc.batched_act(batch_act, observations, self.batch_sizer)
+            self.stats.update(self.batch_sizer.stats())
+        else:
+            predictions = batch_act(observations)
+        return predictions
+
+    def _cascade_batch_act(self, observations):
+        """Process observations with ensemble members in cascade
+
+        Args:
+            :param observations: list object containing observations in format, compatible with agent API
+            :type observations: list
+        Returns:
+            :return: list object containing predictions in raw agent format
+            :rtype: list
+        All observations are processed by the first (cheapest) ensemble member. Only observations with its score
+        inside settings_kpi 'cascade_band' are processed by the rest of members and get weighted ensemble score.
+        Share settings_kpi 'cascade_audit_share' of not escalated observations is also processed by the whole
+        ensemble (their predictions are left as the first member made them) to measure the agreement lost by
+        not escalating them. Numbers of escalated and audited observations, agreement rates of the first member
+        with the ensemble on them and the share of saved members inferences are added to tester stats.
+        """
+        settings_kpi = self.config['kpis'][self.kpi_name]['settings_kpi']
+        band_low, band_high = settings_kpi['cascade_band']
+        audit_share = float(settings_kpi.get('cascade_audit_share', 0))
+        predictions = self.cascade_agents[0].batch_act(observations)
+        first_scores = [float(prediction['score']) for prediction in predictions]
+        escalated = [i for i, score in enumerate(first_scores) if band_low <= score <= band_high]
+        not_escalated = [i for i, score in enumerate(first_scores) if not band_low <= score <= band_high]
+        # Audit sampling continues across batches of testing run, so audited share does not depend on batch size
+        seen = self.stats.get('cascade_not_escalated', 0)
+        audited = [i for n, i in enumerate(not_escalated, seen)
+                   if int((n + 1) * audit_share) > int(n * audit_share)]
+        self.stats['cascade_not_escalated'] = seen + len(not_escalated)
+
+        if len(escalated) + len(audited) > 0:
+            full_observations = [observations[i] for i in escalated + audited]
+            scores = [self.model_coefs[0] * first_scores[i] for i in escalated + audited]
+            for coef, agent in zip(self.model_coefs[1:], self.cascade_agents[1:]):
+                member_predictions = agent.batch_act(full_observations)
+                scores = [score + coef * float(prediction['score'])
+                          for score, prediction in zip(scores, member_predictions)]
+            for i, score in zip(escalated, scores):
+                predictions[i] = dict(predictions[i], score=score)
+            audit_scores = scores[len(escalated):]
+        else:
+            audit_scores = []
+
+        agreed = sum(1 for i in escalated if (first_scores[i] > 0.5) == (predictions[i]['score'] > 0.5))
+        audit_agreed = sum(1 for i, score in zip(audited, audit_scores) if (first_scores[i] > 0.5) == (score > 0.5))
+        members_num = len(self.cascade_agents)
+        inferences_num = len(observations) + (len(escalated) + len(audited)) * (members_num - 1)
+        self.stats['cascade_escalated'] = self.stats.get('cascade_escalated', 0) + len(escalated)
+        self.stats['cascade_agreed'] = self.stats.get('cascade_agreed', 0) + agreed
+        self.stats['cascade_audited'] = self.stats.get('cascade_audited', 0) + len(audited)
+        self.stats['cascade_audit_agreed'] = self.stats.get('cascade_audit_agreed', 0) + audit_agreed
+        self.stats['cascade_inferences'] = self.stats.get('cascade_inferences', 0) + inferences_num
+        self.stats['cascade_full_inferences'] = \
+            self.stats.get('cascade_full_inferences', 0) + len(observations) * members_num
+        self.stats['cascade_agreement_rate'] = \
+            self.stats['cascade_agreed'] / self.stats['cascade_escalated'] if self.stats['cascade_escalated'] else 1.0
+        if self.stats['cascade_audited']:
+            self.stats['cascade_audit_agreement_rate'] = \
+                self.stats['cascade_audit_agreed'] / self.stats['cascade_audited']
+        self.stats['cascade_compute_saved'] = \
+            1 - self.stats['cascade_inferences'] / self.stats['cascade_full_inferences']
         return predictions
 
     def _make_answers(self, session_id, observations, predictions):
@@ -181,9 +391,8 @@ class Tester:
         answers = {}
         answers['sessionId'] = session_id
         answers['answers'] = {}
-        observ_predict = list(zip(observations, predictions))
-        for obs, pred in observ_predict:
-            answers['answers'][obs['id']] = pred['score']
+        for obs_id, pred in zip(observations.ids, predictions):
+            answers['answers'][obs_id] = pred['score']
         return answers
 
     def _get_score(self, answers):
@@ -198,38 +407,71 @@ class Tester:
                 status_code: int with POST request response code
             :rtype: dict
         """
+        import requests
         post_headers = {'Accept': '*/*'}
-        rest_response = requests.post(self.config['kpis'][self.kpi_name]['settings_kpi']['rest_url'],
-                                      json=answers,
-                                      headers=post_headers)
+        settings_kpi = self.config['kpis'][self.kpi_name]['settings_kpi']
+        compression = settings_kpi.get('compression', '')
+        if compression:
+            post_headers['Content-Type'] = 'application/json'
+            post_headers['Content-Encoding'] = compression
+            post_data = cz.compress_body(js.iter_encode(answers), compression)
+            rest_response = requests.post(settings_kpi['rest_url'],
+                                          data=post_data,
+                                          headers=post_headers)
+        else:
+            rest_response = requests.post(settings_kpi['rest_url'],
+                                          json=answers,
+                                          headers=post_headers)
         return {'text': rest_response.text, 'status_code': rest_response.status_code}
 
-    def run_test(self, init_agent=True):
+    def run_test(self, init_agent=True, tasks=None, observations=None):
         """Rune full cycle of KPI testing sequence
 
         Args:
             :param init_agent: bool flag, turns on/off agent [re]initialising before testing sequence
             :type init_agent: bool
+            :param tasks: dict object with tasks, received from the testing system earlier, new tasks are
+                requested if not set
+            :type tasks: dict
+            :param observations: observations set, prepared from tasks earlier (e.g. for other model agent)
         """
         if init_agent:
             self.init_agent()
 
-        tasks = self._get_tasks()
+        self.stats = {}
+        if self.prediction_cache is not None:
+            self.prediction_cache.start_run()
+        # Intermediate data of testing stages is released as soon as it is not needed, unless it is logged
+        keep_state = self.config.get('log_tester_state', 0)
+        if tasks is None and observations is None and not keep_state:
+            tasks, observations = self._get_tasks_observations()
+        elif tasks is None:
+            tasks = self._get_tasks()
         session_id = tasks['id']
         numtasks = tasks['total']
         self.tasks = tasks
         self.session_id = session_id
         self.numtasks = numtasks
 
-        observations = self._make_observations(tasks)
+        if observations is None:
+            observations = self._make_observations(tasks)
         self.observations = observations
+        if not keep_state:
+            self.tasks = tasks = None
 
         predictions = self._get_predictions(observations)
         self.predictions = predictions
 
         answers = self._make_answers(session_id, observations, predictions)
         self.answers = answers
+        if not keep_state:
+            self.observations = observations = None
+            self.predictions = predictions = None
 
         score_response = self._get_score(answers)
         self.score = score_response['text']
         self.response_code = score_response['status_code']
+
+        if self.prediction_cache is not None:
+            self.stats.update(self.prediction_cache.stats())
+            self.prediction_cache.save()
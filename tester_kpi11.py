@@ -14,13 +14,12 @@
 
 
 import os
-import json
-import requests
-import re
-import copy
 
-import build_utils as bu
-from parlai.core.agents import create_agent
+import compression as cz
+import cpu_config as cc
+import conll_utils as cu
+import json_stream as js
+import prediction_cache as pc
 
 
 class Tester:
@@ -39,14 +38,20 @@ class Tester:
         answers: list object prepared for dumping into JSON payload of POST request according testing the system API
         score: string with result of agent predictions scoring by testing system
         response_code: string with the code of the testing system POST request response
+        prediction_cache: PredictionCache object or None if predictions caching is turned off
+        stats: dict object with metrics of the last testing sequence
+        load_stats: dict object with metrics of the last agent initialisation
 
     Public methods:
         init_agent(self): initiates model agent
         update_config(self, config, init_agent=False): updates Tester instance config
         set_numtasks(self, numtasks): updates Tester instance tasks number
-        run_test(self, init_agent=True): evokes full cycle of KPI testing sequence with current config and tasks number
+        run_test(self, init_agent=True, tasks=None, observations=None): evokes full cycle of KPI testing sequence with current config and tasks number
     """
 
+    # Agent creates its own tf.Session, so TensorFlow thread pools settings do not apply to it
+    keras_session = False
+
     def __init__(self, config, opt):
         """Tester class constructor
 
@@ -68,10 +73,16 @@ class Tester:
         self.answers = None
         self.score = None
         self.response_code = None
+        self.prediction_cache = None
+        self.stats = {}
+        self.load_stats = {}
 
     def init_agent(self):
         """Initiate model agent
         """
+        cpu_settings = cc.apply(self.config['kpis'][self.kpi_name]['settings_agent'], self.keras_session)
+        import build_utils as bu
+        from parlai.core.agents import create_agent
         params = ['-t', 'deeppavlov.tasks.coreference_scorer_model.agents:CoreferenceTeacher',
                     '-m', 'deeppavlov.agents.coreference_scorer_model.agents:CoreferenceAgent',
                     '--display-examples', 'False',
@@ -94,6 +105,9 @@ class Tester:
         else:
             opt['embeddings_path'] = os.path.join(embeddings_dir, embedding_file)
         self.agent = create_agent(opt)
+        self.load_stats = cpu_settings
+        self.prediction_cache = pc.create_cache(self.config, self.kpi_name, model_files,
+                                                embedding_file=opt['embeddings_path'])
 
     def update_config(self, config, init_agent=False):
         """Update Tester instance configuration dict
@@ -126,14 +140,23 @@ class Tester:
             :return: dict object initialised with tasks JSON received from the testing system
             :rtype: dict
         """
+        import requests
         get_url = self.config['kpis'][self.kpi_name]['settings_kpi']['rest_url']
         if self.numtasks in [None, 0]:
             test_tasks_number = self.config['kpis'][self.kpi_name]['settings_kpi']['test_tasks_number']
         else:
             test_tasks_number = self.numtasks
         get_params = {'stage': 'test', 'quantity': test_tasks_number}
-        get_response = requests.get(get_url, params=get_params)
-        tasks = json.loads(get_response.text)
+        get_headers = {}
+        accept_encoding = cz.accept_encoding(self.config['kpis'][self.kpi_name]['settings_kpi'].get('compression', ''))
+        if accept_encoding is not None:
+            get_headers['Accept-Encoding'] = accept_encoding
+        # Decode tasks straight from the response bytes stream, without building the whole response text
+        get_response = requests.get(get_url, params=get_params, headers=get_headers, stream=True)
+        try:
+            tasks = js.load(cz.iter_content(get_response, js.CHUNK_SIZE), 'qas')
+        finally:
+            get_response.close()
         return tasks
 
     def _make_observations(self, tasks):
@@ -148,21 +171,8 @@ class Tester:
         """
         id = []
         observs = []
-        for task in tasks['qas']:
-            conll_str = str(task['question'])
-
-            # Preprocess conll
-            doc_num = str(re.search(r'#begin document [(].+[)];\n([0-9]+)', conll_str).group(1))
-            conll_str = re.sub(r'(?P<subst>#begin document [(].+[)];)',
-                               '#begin document(%s); part 0' % doc_num,
-                               conll_str)
-            match = re.search(r'\n\n#end document', conll_str)
-            if match is None:
-                conll_str = re.sub(r'\n#end document', r'\n\n#end document', conll_str)
-
-            # Prepare task
-            observation = {'conll': [], 'valid_conll': [conll_str.split('\n')], 'id': ''}
-            id.append(task['id'])
+        for task_id, observation in cu.iter_observations(tasks['qas']):
+            id.append(task_id)
             observs.append(observation)
         observations = {'id': id, 'observation': observs}
         return observations
@@ -171,26 +181,13 @@ class Tester:
         """Extract coreference markup from conll formatted text
 
         Args:
-            :param conll: list object containing strings of conll text with coreference markup
-            :type conll: list
+            :param conll: string with conll text with coreference markup
+            :type conll: str
         Returns:
             :return: str object containing coreference markup of conll formatted text
             :rtype: str
         """
-        coref_str = ''
-        lines = conll.split('\n')
-        for i in range(len(lines)):
-            if lines[i].startswith("#begin"):
-                coref_str += ' '
-            elif lines[i].startswith("#end document"):
-                coref_str += ' '
-            else:
-                row = lines[i].split('\t')
-                if len(row) == 1:
-                    coref_str += ' '
-                else:
-                    coref_str += row[-1] + ' '
-        return coref_str
+        return cu.extract_coref(conll)
 
     def _get_predictions(self, observations):
         """Process observations with agent's model and get predictions on them
@@ -202,8 +199,25 @@ class Tester:
             :return: list object containing predictions in raw agent format
             :rtype: list
         """
+        if self.prediction_cache is not None:
+            predictions = self.prediction_cache.batch_act(self._batch_act, observations['observation'],
+                                                          lambda observation: '\n'.join(observation['valid_conll'][0]))
+        else:
+            predictions = self._batch_act(observations['observation'])
+        return predictions
+
+    def _batch_act(self, observations):
+        """Process observations with agent's model one by one
+
+        Args:
+            :param observations: list object containing observations in format, compatible with agent API
+            :type observations: list
+        Returns:
+            :return: list object containing predictions (conll lines) extracted from agent's output
+            :rtype: list
+        """
         predictions = []
-        for observation in observations['observation']:
+        for observation in observations:
             self.agent.observe(observation)
             prediction = self.agent.act()
             predictions.append(prediction['valid_conll'][0])
@@ -225,7 +239,8 @@ class Tester:
         observe_predict = list(zip(observations['id'], predictions))
         for obs, pred in observe_predict:
             id_predict[obs] = self._extract_coref(''.join(pred))
-        tasks = copy.deepcopy(self.tasks)
+        # Shallow copy: tasks are not modified, so the answers payload shares them instead of duplicating
+        tasks = dict(self.tasks)
         tasks['answers'] = id_predict
         return tasks
 
@@ -241,30 +256,59 @@ class Tester:
                 status_code: int with POST request response code
             :rtype: dict
         """
+        import requests
         post_headers = {'Accept': '*/*'}
-        rest_response = requests.post(self.config['kpis'][self.kpi_name]['settings_kpi']['rest_url'],
-                                      json=answers,
-                                      headers=post_headers)
+        settings_kpi = self.config['kpis'][self.kpi_name]['settings_kpi']
+        compression = settings_kpi.get('compression', '')
+        if settings_kpi.get('stream_answers', 0) or compression:
+            post_headers['Content-Type'] = 'application/json'
+            if settings_kpi.get('stream_answers', 0):
+                # Serialise answers incrementally and send them with chunked transfer encoding
+                post_data = js.iter_encode(answers)
+                if compression:
+                    post_headers['Content-Encoding'] = compression
+                    post_data = cz.compress_threaded(post_data, compression)
+            else:
+                post_headers['Content-Encoding'] = compression
+                post_data = cz.compress_body(js.iter_encode(answers), compression)
+            rest_response = requests.post(settings_kpi['rest_url'],
+                                          data=post_data,
+                                          headers=post_headers)
+        else:
+            rest_response = requests.post(settings_kpi['rest_url'],
+                                          json=answers,
+                                          headers=post_headers)
         return {'text': rest_response.text, 'status_code': rest_response.status_code}
 
-    def run_test(self, init_agent=True):
+    def run_test(self, init_agent=True, tasks=None, observations=None):
         """Rune full cycle of KPI testing sequence
 
         Args:
             :param init_agent: bool flag, turns on/off agent [re]initialising before testing sequence
             :type init_agent: bool
+            :param tasks: dict object with tasks, received from the testing system earlier, new tasks are
+                requested if not set
+            :type tasks: dict
+            :param observations: observations set, prepared from tasks earlier (e.g. for other model agent)
         """
         if init_agent:
             self.init_agent()
 
-        tasks = self._get_tasks()
+        self.stats = {}
+        if self.prediction_cache is not None:
+            self.prediction_cache.start_run()
+        # Intermediate data of testing stages is released as soon as it is not needed, unless it is logged
+        keep_state = self.config.get('log_tester_state', 0)
+        if tasks is None:
+            tasks = self._get_tasks()
         session_id = tasks['id']
         numtasks = tasks['total']
         self.tasks = tasks
         self.session_id = session_id
         self.numtasks = numtasks
 
-        observations = self._make_observations(tasks)
+        if observations is None:
+            observations = self._make_observations(tasks)
         self.observations = observations
 
         predictions = self._get_predictions(observations)
@@ -272,7 +316,14 @@ class Tester:
 
         answers = self._make_answers(observations, predictions)
         self.answers = answers
+        if not keep_state:
+            self.observations = observations = None
+            self.predictions = predictions = None
 
         score_response = self._get_score(answers)
         self.score = score_response['text']
         self.response_code = score_response['status_code']
+
+        if self.prediction_cache is not None:
+            self.stats.update(self.prediction_cache.stats())
+            self.prediction_cache.save()
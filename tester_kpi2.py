@@ -14,12 +14,14 @@
 
 
 import os
-import json
-import requests
-import numpy as np
 
-import build_utils as bu
-from parlai.core.agents import create_agent
+import batch_controller as bc
+import compression as cz
+import cpu_config as cc
+import json_stream as js
+import model_loader as ml
+import prediction_cache as pc
+import observation_utils as ou
 
 
 class Tester:
@@ -38,14 +40,21 @@ class Tester:
         answers: list object prepared for dumping into JSON payload of POST request according testing the system API
         score: string with result of agent predictions scoring by testing system
         response_code: string with the code of the testing system POST request response
+        prediction_cache: PredictionCache object or None if predictions caching is turned off
+        batch_sizer: AdaptiveBatchSizer object or None if observations batch size is not adaptive
+        stats: dict object with metrics of the last testing sequence
+        load_stats: dict object with metrics of the last agent initialisation
 
     Public methods:
         init_agent(self): initiates model agent
         update_config(self, config, init_agent=False): updates Tester instance config
         set_numtasks(self, numtasks): updates Tester instance tasks number
-        run_test(self, init_agent=True): evokes full cycle of KPI testing sequence with current config and tasks number
+        run_test(self, init_agent=True, tasks=None, observations=None): evokes full cycle of KPI testing sequence with current config and tasks number
     """
 
+    # Agent runs its models in Keras session, so TensorFlow thread pools settings apply to it
+    keras_session = True
+
     def __init__(self, config, opt):
         self.agent = None
         self.config = config
@@ -60,10 +69,17 @@ class Tester:
         self.answers = None
         self.score = None
         self.response_code = None
+        self.prediction_cache = None
+        self.batch_sizer = None
+        self.stats = {}
+        self.load_stats = {}
 
     def init_agent(self):
         """Initiate model agent
         """
+        cpu_settings = cc.apply(self.config['kpis'][self.kpi_name]['settings_agent'], self.keras_session)
+        import build_utils as bu
+        from parlai.core.agents import create_agent
         params = ['-t', 'deeppavlov.tasks.paraphrases.agents',
                     '-m', 'deeppavlov.agents.paraphraser.paraphraser:EnsembleParaphraserAgent',
                     '--datatype', 'test',
@@ -80,7 +96,12 @@ class Tester:
             opt['fasttext_model'] = self.opt['embedding_file']
         else:
             opt['fasttext_model'] = os.path.join(embeddings_dir, embedding_file)
-        self.agent = create_agent(opt)
+        load_workers = self.config['kpis'][self.kpi_name]['settings_agent'].get('load_workers', 0)
+        self.agent, self.load_stats = ml.timed_create_agent(create_agent, opt, model_files, load_workers)
+        self.load_stats.update(cpu_settings)
+        self.batch_sizer = bc.create_sizer(self.config['kpis'][self.kpi_name]['settings_kpi'])
+        self.prediction_cache = pc.create_cache(self.config, self.kpi_name, model_files,
+                                                embedding_file=opt['fasttext_model'])
 
     def update_config(self, config, init_agent=False):
         """Update Tester instance configuration dict
@@ -107,23 +128,72 @@ class Tester:
         """
         self.numtasks = numtasks
 
-    def _get_tasks(self):
-        """Send GET request to testing system and get tasks set
+    def _request_tasks(self):
+        """Send GET request to testing system for tasks set
 
         Returns:
-            :return: dict object initialised with tasks JSON received from the testing system
-            :rtype: dict
+            :return: requests.Response object with not read tasks JSON stream
+            :rtype: requests.Response
         """
+        import requests
         get_url = self.config['kpis'][self.kpi_name]['settings_kpi']['rest_url']
         if self.numtasks in [None, 0]:
             test_tasks_number = self.config['kpis'][self.kpi_name]['settings_kpi']['test_tasks_number']
         else:
             test_tasks_number = self.numtasks
         get_params = {'stage': 'test', 'quantity': test_tasks_number}
-        get_response = requests.get(get_url, params=get_params)
-        tasks = json.loads(get_response.text)
+        get_headers = {}
+        accept_encoding = cz.accept_encoding(self.config['kpis'][self.kpi_name]['settings_kpi'].get('compression', ''))
+        if accept_encoding is not None:
+            get_headers['Accept-Encoding'] = accept_encoding
+        return requests.get(get_url, params=get_params, headers=get_headers, stream=True)
+
+    def _get_tasks(self):
+        """Send GET request to testing system and get tasks set
+
+        Returns:
+            :return: dict object initialised with tasks JSON received from the testing system
+            :rtype: dict
+        """
+        # Decode tasks straight from the response bytes stream, without building the whole response text
+        get_response = self._request_tasks()
+        try:
+            tasks = js.load(cz.iter_content(get_response, js.CHUNK_SIZE), 'qas')
+        finally:
+            get_response.close()
         return tasks
 
+    def _get_tasks_observations(self):
+        """Send GET request to testing system and prepare observation set while tasks are decoded
+
+        Returns:
+            :return: tuple with dict object with tasks top level fields (without tasks themselves)
+                and ObservationBatch object containing observations
+            :rtype: tuple
+        Used when tasks are not logged: each task is decoded from response stream and only its id and
+        observation text are kept, so tasks dicts are never held all together.
+        """
+        tasks = {}
+        ids = []
+        texts = []
+        phrases = set()
+        get_response = self._request_tasks()
+        try:
+            for event, key, task in js.iter_object(cz.iter_content(get_response, js.CHUNK_SIZE), 'qas'):
+                if event == 'item':
+                    ids.append(task['id'])
+                    texts.append('Dummy title\n%s\n%s' % (task['phrase1'], task['phrase2']))
+                    phrases.add(task['phrase1'])
+                    phrases.add(task['phrase2'])
+                else:
+                    tasks[key] = task
+        finally:
+            get_response.close()
+        observations = ou.ObservationBatch(ids, texts)
+        self.stats['phrases'] = 2 * len(observations)
+        self.stats['unique_phrases'] = len(phrases)
+        return tasks, observations
+
     def _make_observations(self, tasks):
         """Prepare observation set according agent API
 
@@ -131,15 +201,19 @@ class Tester:
             :param tasks: dict object initialised with tasks JSON received from the testing system
             :type tasks: dict
         Returns:
-            :return: list object containing observations in format, compatible with agent API
-            :rtype: list
+            :return: ObservationBatch object containing observations in format, compatible with agent API
+            :rtype: ObservationBatch
         """
-        observations = []
+        observations = ou.ObservationBatch([task['id'] for task in tasks['qas']],
+                                           ('Dummy title\n%s\n%s' % (task['phrase1'], task['phrase2'])
+                                            for task in tasks['qas']))
+        phrases = set()
         for task in tasks['qas']:
-            observations.append({
-                'id': task['id'],
-                'text': 'Dummy title\n%s\n%s' % (task['phrase1'], task['phrase2']),
-            })
+            phrases.add(task['phrase1'])
+            phrases.add(task['phrase2'])
+        # Phrases reuse across pairs, shows how much of phrases encoding work is repeated by agent
+        self.stats['phrases'] = 2 * len(observations)
+        self.stats['unique_phrases'] = len(phrases)
         return observations
 
     def _get_predictions(self, observations):
@@ -152,7 +226,39 @@ class Tester:
             :return: list object containing predictions in raw agent format
             :rtype: list
         """
-        predictions = self.agent.batch_act(observations)
+        dedup_observations = self.config['kpis'][self.kpi_name]['settings_kpi'].get('dedup_observations', 0)
+        if dedup_observations:
+            # Process each unique observation text once and share prediction between duplicates
+            unique_observations, observations_index = ou.dedup_observations(observations)
+            self.stats['observations'] = len(observations)
+            self.stats['unique_observations'] = len(unique_observations)
+        else:
+            unique_observations = list(observations)
+
+        if self.prediction_cache is not None:
+            predictions = self.prediction_cache.batch_act(self._batch_act, unique_observations)
+        else:
+            predictions = self._batch_act(unique_observations)
+
+        if dedup_observations:
+            predictions = ou.fanout_predictions(predictions, observations_index, observations.ids)
+        return predictions
+
+    def _batch_act(self, observations):
+        """Process observations with agent's model, in batches of adaptive size if batch sizer is configured
+
+        Args:
+            :param observations: list object containing observations in format, compatible with agent API
+            :type observations: list
+        Returns:
+            :return: list object containing predictions in raw agent format
+            :rtype: list
+        """
+        if self.batch_sizer is not None:
+            predictions = bc.batched_act(self.agent.batch_act, observations, self.batch_sizer)
+            self.stats.update(self.batch_sizer.stats())
+        else:
+            predictions = self.agent.batch_act(observations)
         return predictions
 
     def _make_answers(self, session_id, observations, predictions):
@@ -167,14 +273,28 @@ class Tester:
             :return: dict object containing answers to task, compatible with test system API for current KPI
             :rtype: dict
         """
+        import numpy as np
+        scores = self._get_scores(predictions)
+        # Threshold all scores at once, score 0.5 is treated as paraphrase
+        labels = np.where(scores == 0.5, 1.0, np.round(scores))
         answers = {}
         answers['sessionId'] = session_id
-        answers['answers'] = {}
-        observ_predict = list(zip(observations, predictions))
-        for obs, pred in observ_predict:
-            answers['answers'][obs['id']] = (lambda s: np.float64((1 if s == 0.5 else round(s))))(pred['score'][0])
+        answers['answers'] = dict(zip(observations.ids, labels.tolist()))
         return answers
 
+    def _get_scores(self, predictions):
+        """Collect paraphrase scores of predictions to one array
+
+        Args:
+            :param predictions: list object containing predictions in raw agent format
+            :type predictions: list
+        Returns:
+            :return: array of paraphrase scores in order of predictions
+            :rtype: numpy.ndarray
+        """
+        import numpy as np
+        return np.fromiter((pred['score'][0] for pred in predictions), dtype=np.float64, count=len(predictions))
+
     def _get_score(self, answers):
         """Prepare POST request with answers, send to the KPI endpoint and get score
 
@@ -187,38 +307,71 @@ class Tester:
                 status_code: int with POST request response code
             :rtype: dict
         """
+        import requests
         post_headers = {'Accept': '*/*'}
-        rest_response = requests.post(self.config['kpis'][self.kpi_name]['settings_kpi']['rest_url'],
-                                      json=answers,
-                                      headers=post_headers)
+        settings_kpi = self.config['kpis'][self.kpi_name]['settings_kpi']
+        compression = settings_kpi.get('compression', '')
+        if compression:
+            post_headers['Content-Type'] = 'application/json'
+            post_headers['Content-Encoding'] = compression
+            post_data = cz.compress_body(js.iter_encode(answers), compression)
+            rest_response = requests.post(settings_kpi['rest_url'],
+                                          data=post_data,
+                                          headers=post_headers)
+        else:
+            rest_response = requests.post(settings_kpi['rest_url'],
+                                          json=answers,
+                                          headers=post_headers)
         return {'text': rest_response.text, 'status_code': rest_response.status_code}
 
-    def run_test(self, init_agent=True):
+    def run_test(self, init_agent=True, tasks=None, observations=None):
         """Rune full cycle of KPI testing sequence
 
         Args:
             :param init_agent: bool flag, turns on/off agent [re]initialising before testing sequence
             :type init_agent: bool
+            :param tasks: dict object with tasks, received from the testing system earlier, new tasks are
+                requested if not set
+            :type tasks: dict
+            :param observations: observations set, prepared from tasks earlier (e.g. for other model agent)
         """
         if init_agent:
             self.init_agent()
 
-        tasks = self._get_tasks()
+        self.stats = {}
+        if self.prediction_cache is not None:
+            self.prediction_cache.start_run()
+        # Intermediate data of testing stages is released as soon as it is not needed, unless it is logged
+        keep_state = self.config.get('log_tester_state', 0)
+        if tasks is None and observations is None and not keep_state:
+            tasks, observations = self._get_tasks_observations()
+        elif tasks is None:
+            tasks = self._get_tasks()
         session_id = tasks['id']
         numtasks = tasks['total']
         self.tasks = tasks
         self.session_id = session_id
         self.numtasks = numtasks
 
-        observations = self._make_observations(tasks)
+        if observations is None:
+            observations = self._make_observations(tasks)
         self.observations = observations
+        if not keep_state:
+            self.tasks = tasks = None
 
         predictions = self._get_predictions(observations)
         self.predictions = predictions
 
         answers = self._make_answers(session_id, observations, predictions)
         self.answers = answers
+        if not keep_state:
+            self.observations = observations = None
+            self.predictions = predictions = None
 
         score_response = self._get_score(answers)
         self.score = score_response['text']
         self.response_code = score_response['status_code']
+
+        if self.prediction_cache is not None:
+            self.stats.update(self.prediction_cache.stats())
+            self.prediction_cache.save()
@@ -14,12 +14,12 @@
 
 
 import os
-import json
-import requests
-import copy
 
-import build_utils as bu
-from parlai.core.agents import create_agent
+import compression as cz
+import cpu_config as cc
+import json_stream as js
+import observation_utils as ou
+import prediction_cache as pc
 
 
 class Tester:
@@ -38,14 +38,20 @@ class Tester:
         answers: list object prepared for dumping into JSON payload of POST request according testing the system API
         score: string with result of agent predictions scoring by testing system
         response_code: string with the code of the testing system POST request response
+        prediction_cache: PredictionCache object or None if predictions caching is turned off
+        stats: dict object with metrics of the last testing sequence
+        load_stats: dict object with metrics of the last agent initialisation
 
     Public methods:
         init_agent(self): initiates model agent
         update_config(self, config, init_agent=False): updates Tester instance config
         set_numtasks(self, numtasks): updates Tester instance tasks number
-        run_test(self, init_agent=True): evokes full cycle of KPI testing sequence with current config and tasks number
+        run_test(self, init_agent=True, tasks=None, observations=None): evokes full cycle of KPI testing sequence with current config and tasks number
     """
 
+    # Agent creates its own tf.Session, so TensorFlow thread pools settings do not apply to it
+    keras_session = False
+
     def __init__(self, config, opt):
         """Tester class constructor
 
@@ -67,10 +73,16 @@ class Tester:
         self.answers = None
         self.score = None
         self.response_code = None
+        self.prediction_cache = None
+        self.stats = {}
+        self.load_stats = {}
 
     def init_agent(self):
         """Initiate model agent
         """
+        cpu_settings = cc.apply(self.config['kpis'][self.kpi_name]['settings_agent'], self.keras_session)
+        import build_utils as bu
+        from parlai.core.agents import create_agent
         params = ['-t', 'deeppavlov.tasks.ner.agents',
             '-m', 'deeppavlov.agents.ner.ner:NERAgent',
             '-dt', 'test',
@@ -87,6 +99,8 @@ class Tester:
         opt['pretrained_model'] = os.path.dirname(model_files[0])
         opt['dict_file'] = os.path.join(os.path.dirname(model_files[0]), dict_file)
         self.agent = create_agent(opt)
+        self.load_stats = cpu_settings
+        self.prediction_cache = pc.create_cache(self.config, self.kpi_name, model_files)
 
 
     def update_config(self, config, init_agent=False):
@@ -120,14 +134,23 @@ class Tester:
             :return: dict object initialised with tasks JSON received from the testing system
             :rtype: dict
         """
+        import requests
         get_url = self.config['kpis'][self.kpi_name]['settings_kpi']['rest_url']
         if self.numtasks in [None, 0]:
             test_tasks_number = self.config['kpis'][self.kpi_name]['settings_kpi']['test_tasks_number']
         else:
             test_tasks_number = self.numtasks
         get_params = {'stage': 'test', 'quantity': test_tasks_number}
-        get_response = requests.get(get_url, params=get_params)
-        tasks = json.loads(get_response.text)
+        get_headers = {}
+        accept_encoding = cz.accept_encoding(self.config['kpis'][self.kpi_name]['settings_kpi'].get('compression', ''))
+        if accept_encoding is not None:
+            get_headers['Accept-Encoding'] = accept_encoding
+        # Decode tasks straight from the response bytes stream, without building the whole response text
+        get_response = requests.get(get_url, params=get_params, headers=get_headers, stream=True)
+        try:
+            tasks = js.load(cz.iter_content(get_response, js.CHUNK_SIZE), 'qas')
+        finally:
+            get_response.close()
         return tasks
 
     def _make_observations(self, tasks):
@@ -137,16 +160,12 @@ class Tester:
             :param tasks: dict object initialised with tasks JSON received from the testing system
             :type tasks: dict
         Returns:
-            :return: list object containing observations in format, compatible with agent API
-            :rtype: list
+            :return: ObservationBatch object containing observations in format, compatible with agent API
+            :rtype: ObservationBatch
         """
-        observations = []
-        for task in tasks['qas']:
-            observations.append({
-                'id': task['id'],
-                # Preprocess task
-                'text': task['question'].split('\t')[0]
-            })
+        observations = ou.ObservationBatch([task['id'] for task in tasks['qas']],
+                                           # Preprocess task
+                                           (task['question'].split('\t')[0] for task in tasks['qas']))
         return observations
 
     def _get_predictions(self, observations):
@@ -159,11 +178,30 @@ class Tester:
             :return: list object containing predictions (NER markup), extracted from each observation processing by agent
             :rtype: list
         """
+        if self.prediction_cache is not None:
+            agent_predictions = self.prediction_cache.batch_act(self._batch_act, observations)
+        else:
+            agent_predictions = self._batch_act(observations)
+        predictions = []
+        for prediction in agent_predictions:
+            predictions.append({'id': prediction['id'],'text': prediction['text']})
+        return predictions
+
+    def _batch_act(self, observations):
+        """Process observations with agent's model
+
+        Args:
+            :param observations: list object containing observations in format, compatible with agent API
+            :type observations: list
+        Returns:
+            :return: list object containing predictions in raw agent format
+            :rtype: list
+        """
         # Using agent.batch_act via feeding model 1 by 1 observation from batch
         predictions = []
         for observation in observations:
             prediction = self.agent.batch_act([observation])
-            predictions.append({'id': prediction[0]['id'],'text': prediction[0]['text']})
+            predictions.append(prediction[0])
         return predictions
 
     def _make_answers(self, observations, predictions):
@@ -179,10 +217,10 @@ class Tester:
             :rtype: dict
         """
         answers = {}
-        observ_predict = list(zip(observations, predictions))
-        for obs, pred in observ_predict:
-            answers[obs['id']] = pred['text']
-        tasks = copy.deepcopy(self.tasks)
+        for obs_id, pred in zip(observations.ids, predictions):
+            answers[obs_id] = pred['text']
+        # Shallow copy: tasks are not modified, so the answers payload shares them instead of duplicating
+        tasks = dict(self.tasks)
         tasks['answers'] = answers
         return tasks
 
@@ -198,30 +236,59 @@ class Tester:
                 status_code: int with POST request response code
             :rtype: dict
         """
+        import requests
         post_headers = {'Accept': '*/*'}
-        rest_response = requests.post(self.config['kpis'][self.kpi_name]['settings_kpi']['rest_url'],
-                                      json=answers,
-                                      headers=post_headers)
+        settings_kpi = self.config['kpis'][self.kpi_name]['settings_kpi']
+        compression = settings_kpi.get('compression', '')
+        if settings_kpi.get('stream_answers', 0) or compression:
+            post_headers['Content-Type'] = 'application/json'
+            if settings_kpi.get('stream_answers', 0):
+                # Serialise answers incrementally and send them with chunked transfer encoding
+                post_data = js.iter_encode(answers)
+                if compression:
+                    post_headers['Content-Encoding'] = compression
+                    post_data = cz.compress_threaded(post_data, compression)
+            else:
+                post_headers['Content-Encoding'] = compression
+                post_data = cz.compress_body(js.iter_encode(answers), compression)
+            rest_response = requests.post(settings_kpi['rest_url'],
+                                          data=post_data,
+                                          headers=post_headers)
+        else:
+            rest_response = requests.post(settings_kpi['rest_url'],
+                                          json=answers,
+                                          headers=post_headers)
         return {'text': rest_response.text, 'status_code': rest_response.status_code}
 
-    def run_test(self, init_agent=True):
+    def run_test(self, init_agent=True, tasks=None, observations=None):
         """Rune full cycle of KPI testing sequence
 
         Args:
             :param init_agent: bool flag, turns on/off agent [re]initialising before testing sequence
             :type init_agent: bool
+            :param tasks: dict object with tasks, received from the testing system earlier, new tasks are
+                requested if not set
+            :type tasks: dict
+            :param observations: observations set, prepared from tasks earlier (e.g. for other model agent)
         """
         if init_agent:
             self.init_agent()
 
-        tasks = self._get_tasks()
+        self.stats = {}
+        if self.prediction_cache is not None:
+            self.prediction_cache.start_run()
+        # Intermediate data of testing stages is released as soon as it is not needed, unless it is logged
+        keep_state = self.config.get('log_tester_state', 0)
+        if tasks is None:
+            tasks = self._get_tasks()
         session_id = tasks['id']
         numtasks = tasks['total']
         self.tasks = tasks
         self.session_id = session_id
         self.numtasks = numtasks
 
-        observations = self._make_observations(tasks)
+        if observations is None:
+            observations = self._make_observations(tasks)
         self.observations = observations
 
         predictions = self._get_predictions(observations)
@@ -229,7 +296,14 @@ class Tester:
 
         answers = self._make_answers(observations, predictions)
         self.answers = answers
+        if not keep_state:
+            self.observations = observations = None
+            self.predictions = predictions = None
 
         score_response = self._get_score(answers)
         self.score = score_response['text']
         self.response_code = score_response['status_code']
+
+        if self.prediction_cache is not None:
+            self.stats.update(self.prediction_cache.stats())
+            self.prediction_cache.save()
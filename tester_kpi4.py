@@ -14,12 +14,13 @@
 
 
 import os
-import json
-import requests
-import copy
 
-import build_utils as bu
-from parlai.core.agents import create_agent
+import batch_controller as bc
+import compression as cz
+import cpu_config as cc
+import json_stream as js
+import observation_utils as ou
+import prediction_cache as pc
 
 
 class Tester:
@@ -38,14 +39,21 @@ class Tester:
         answers: list object prepared for dumping into JSON payload of POST request according testing the system API
         score: string with result of agent predictions scoring by testing system
         response_code: string with the code of the testing system POST request response
+        prediction_cache: PredictionCache object or None if predictions caching is turned off
+        batch_sizer: AdaptiveBatchSizer object or None if observations batch size is not adaptive
+        stats: dict object with metrics of the last testing sequence
+        load_stats: dict object with metrics of the last agent initialisation
 
     Public methods:
         init_agent(self): initiates model agent
         update_config(self, config, init_agent=False): updates Tester instance config
         set_numtasks(self, numtasks): updates Tester instance tasks number
-        run_test(self, init_agent=True): evokes full cycle of KPI testing sequence with current config and tasks number
+        run_test(self, init_agent=True, tasks=None, observations=None): evokes full cycle of KPI testing sequence with current config and tasks number
     """
 
+    # Agent creates its own tf.Session, so TensorFlow thread pools settings do not apply to it
+    keras_session = False
+
     def __init__(self, config, opt):
         """Tester class constructor
 
@@ -67,10 +75,17 @@ class Tester:
         self.answers = None
         self.score = None
         self.response_code = None
+        self.prediction_cache = None
+        self.batch_sizer = None
+        self.stats = {}
+        self.load_stats = {}
 
     def init_agent(self):
         """Initiate model agent
         """
+        cpu_settings = cc.apply(self.config['kpis'][self.kpi_name]['settings_agent'], self.keras_session)
+        import build_utils as bu
+        from parlai.core.agents import create_agent
         params = ['-t', 'squad',
                     '-m', 'deeppavlov.agents.squad.squad:SquadAgent',
                     '--batchsize', '64',
@@ -108,6 +123,10 @@ class Tester:
         else:
             opt['embedding_file'] = os.path.join(embeddings_dir, embedding_file)
         self.agent = create_agent(opt)
+        self.load_stats = cpu_settings
+        self.batch_sizer = bc.create_sizer(self.config['kpis'][self.kpi_name]['settings_kpi'])
+        self.prediction_cache = pc.create_cache(self.config, self.kpi_name, model_files,
+                                                embedding_file=opt['embedding_file'])
 
     def update_config(self, config, init_agent=False):
         """Update Tester instance configuration dict
@@ -140,14 +159,23 @@ class Tester:
             :return: dict object initialised with tasks JSON received from the testing system
             :rtype: dict
         """
+        import requests
         get_url = self.config['kpis'][self.kpi_name]['settings_kpi']['rest_url']
         if self.numtasks in [None, 0]:
             test_tasks_number = self.config['kpis'][self.kpi_name]['settings_kpi']['test_tasks_number']
         else:
             test_tasks_number = self.numtasks
         get_params = {'stage': 'test', 'quantity': test_tasks_number}
-        get_response = requests.get(get_url, params=get_params)
-        tasks = json.loads(get_response.text)
+        get_headers = {}
+        accept_encoding = cz.accept_encoding(self.config['kpis'][self.kpi_name]['settings_kpi'].get('compression', ''))
+        if accept_encoding is not None:
+            get_headers['Accept-Encoding'] = accept_encoding
+        # Decode tasks straight from the response bytes stream, without building the whole response text
+        get_response = requests.get(get_url, params=get_params, headers=get_headers, stream=True)
+        try:
+            tasks = js.load(cz.iter_content(get_response, js.CHUNK_SIZE), 'paragraphs')
+        finally:
+            get_response.close()
         return tasks
 
     def _make_observations(self, tasks):
@@ -157,15 +185,21 @@ class Tester:
             :param tasks: dict object initialised with tasks JSON received from the testing system
             :type tasks: dict
         Returns:
-            :return: list object containing observations in format, compatible with agent API
-            :rtype: list
+            :return: ObservationBatch object containing observations in format, compatible with agent API
+            :rtype: ObservationBatch
+        Observation text is paragraph context and question separated by newline, each context is stored once
         """
-        observations = []
+        ids = []
+        questions = []
+        contexts = []
+        context_index = []
         for task in tasks['paragraphs']:
+            contexts.append('%s\n' % task['context'])
             for question in task['qas']:
-                observations.append({
-                    'id': question['id'],
-                    'text': '%s\n%s' % (task['context'], question['question'])})
+                ids.append(question['id'])
+                questions.append(question['question'])
+                context_index.append(len(contexts) - 1)
+        observations = ou.ObservationBatch(ids, questions, contexts, context_index)
         return observations
 
     def _batchfy_observations(self, observations, batch_length):
@@ -177,14 +211,33 @@ class Tester:
             :param batch_length: int number containing number of observations in one sub-batch
             :type batch_length: int
         Returns:
-            :return: list object containing lists of observations with number elements <= batch_length value
-            :rtype: list
+            :return: generator of lists of observations with number elements <= batch_length value
+            :rtype: generator
+        Batches are sliced lazily, so observations dicts (with their context texts) are materialised
+        only for the batch being processed.
         """
-        return [observations[i:i + batch_length] for i in range(0, len(observations), batch_length)]
+        for i in range(0, len(observations), batch_length):
+            yield observations[i:i + batch_length]
 
     def _get_predictions(self, observations):
         """Process observations with agent's model and get predictions on them
 
+        Args:
+            :param observations: list object containing observations in format, compatible with agent API
+            :type observations: list
+        Returns:
+            :return: list object containing predictions in raw agent format
+            :rtype: list
+        """
+        if self.prediction_cache is not None:
+            predictions = self.prediction_cache.batch_act(self._batch_act, observations)
+        else:
+            predictions = self._batch_act(observations)
+        return predictions
+
+    def _batch_act(self, observations):
+        """Process observations with agent's model, splitting them to batches of configured or adaptive size
+
         Args:
             :param observations: list object containing observations in format, compatible with agent API
             :type observations: list
@@ -193,13 +246,15 @@ class Tester:
             :rtype: list
         """
         observations_batchsize = int(self.config['kpis'][self.kpi_name]['settings_kpi']['observations_batchsize'])
-        if observations_batchsize == 0:
-            predictions = self.agent.batch_act(observations)
+        if self.batch_sizer is not None:
+            predictions = bc.batched_act(self.agent.batch_act, observations, self.batch_sizer)
+            self.stats.update(self.batch_sizer.stats())
+        elif observations_batchsize == 0:
+            predictions = self.agent.batch_act(list(observations))
         elif observations_batchsize > 0:
             # Split batch of observations for several batches and process observations via algorithm
             predictions = []
-            observ_batch = self._batchfy_observations(observations, observations_batchsize)
-            for observ in observ_batch:
+            for observ in self._batchfy_observations(observations, observations_batchsize):
                 predict = self.agent.batch_act(observ)
                 predictions.extend(predict)
         return predictions
@@ -217,10 +272,10 @@ class Tester:
             :rtype: dict
         """
         answers = {}
-        observ_predict = list(zip(observations, predictions))
-        for obs, pred in observ_predict:
-            answers[obs['id']] = pred['text']
-        tasks = copy.deepcopy(self.tasks)
+        for obs_id, pred in zip(observations.ids, predictions):
+            answers[obs_id] = pred['text']
+        # Shallow copy: tasks are not modified, so the answers payload shares them instead of duplicating
+        tasks = dict(self.tasks)
         tasks['answers'] = answers
         return tasks
 
@@ -236,30 +291,59 @@ class Tester:
                 status_code: int with POST request response code
             :rtype: dict
         """
+        import requests
         post_headers = {'Accept': '*/*'}
-        rest_response = requests.post(self.config['kpis'][self.kpi_name]['settings_kpi']['rest_url'],
-                                      json=answers,
-                                      headers=post_headers)
+        settings_kpi = self.config['kpis'][self.kpi_name]['settings_kpi']
+        compression = settings_kpi.get('compression', '')
+        if settings_kpi.get('stream_answers', 0) or compression:
+            post_headers['Content-Type'] = 'application/json'
+            if settings_kpi.get('stream_answers', 0):
+                # Serialise answers incrementally and send them with chunked transfer encoding
+                post_data = js.iter_encode(answers)
+                if compression:
+                    post_headers['Content-Encoding'] = compression
+                    post_data = cz.compress_threaded(post_data, compression)
+            else:
+                post_headers['Content-Encoding'] = compression
+                post_data = cz.compress_body(js.iter_encode(answers), compression)
+            rest_response = requests.post(settings_kpi['rest_url'],
+                                          data=post_data,
+                                          headers=post_headers)
+        else:
+            rest_response = requests.post(settings_kpi['rest_url'],
+                                          json=answers,
+                                          headers=post_headers)
         return {'text': rest_response.text, 'status_code': rest_response.status_code}
 
-    def run_test(self, init_agent=True):
+    def run_test(self, init_agent=True, tasks=None, observations=None):
         """Rune full cycle of KPI testing sequence
 
         Args:
             :param init_agent: bool flag, turns on/off agent [re]initialising before testing sequence
             :type init_agent: bool
+            :param tasks: dict object with tasks, received from the testing system earlier, new tasks are
+                requested if not set
+            :type tasks: dict
+            :param observations: observations set, prepared from tasks earlier (e.g. for other model agent)
         """
         if init_agent:
             self.init_agent()
 
-        tasks = self._get_tasks()
+        self.stats = {}
+        if self.prediction_cache is not None:
+            self.prediction_cache.start_run()
+        # Intermediate data of testing stages is released as soon as it is not needed, unless it is logged
+        keep_state = self.config.get('log_tester_state', 0)
+        if tasks is None:
+            tasks = self._get_tasks()
         session_id = tasks['id']
         numtasks = tasks['total']
         self.tasks = tasks
         self.session_id = session_id
         self.numtasks = numtasks
 
-        observations = self._make_observations(tasks)
+        if observations is None:
+            observations = self._make_observations(tasks)
         self.observations = observations
 
         predictions = self._get_predictions(observations)
@@ -267,7 +351,14 @@ class Tester:
 
         answers = self._make_answers(observations, predictions)
         self.answers = answers
+        if not keep_state:
+            self.observations = observations = None
+            self.predictions = predictions = None
 
         score_response = self._get_score(answers)
         self.score = score_response['text']
         self.response_code = score_response['status_code']
+
+        if self.prediction_cache is not None:
+            self.stats.update(self.prediction_cache.stats())
+            self.prediction_cache.save()